@@ -0,0 +1,186 @@
+"""
+Searches the ancestors of every person in a CSV or JSONL file
+
+  python batch.py Abaran.xlsx Blanca.xlsx -i personas.csv -o arboles.jsonl
+
+Each input row has the fields of SearchInfo (nombre, apellido_1, apellido_2,
+nombre_padre, nombre_madre and optionally year_child) and an optional id
+(the row number by default). Each result is a JSON line with the id, the
+query, the tree size, the search time and the tree, written as soon as it is
+found (with --trace, also the trace of the search of each person). Running
+the same command again skips the ids already in the output, so an
+interrupted run can be resumed. Rows that can't be read are reported and
+skipped, and a search that fails writes a line with its error instead of the
+tree.
+"""
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import asdict, fields
+
+import lib
+
+_SEARCH_FIELDS = [f.name for f in fields(lib.SearchInfo)]
+
+
+def parse_person(row, n: int) -> tuple[str, lib.SearchInfo]:
+  # (id, SearchInfo) of the row number n. ValueError if it can't be searched
+  if not isinstance(row, dict):
+    raise ValueError("no es un objeto JSON")
+  # The cells of a CSV row beyond the header are under the key None
+  row = {k.strip().lower().replace(" ", "_"): v for k, v in row.items() if k is not None}
+  values = {k: (str(row[k]).strip() or None) if row.get(k) is not None else None
+            for k in _SEARCH_FIELDS}
+  if values["year_child"]:
+    # 1800.0 when the CSV comes from a spreadsheet
+    try:
+      values["year_child"] = int(float(values["year_child"]))
+    except (ValueError, OverflowError):
+      raise ValueError(f"year_child no válido ({values['year_child']!r})") from None
+  return str(row.get("id") or n), lib.SearchInfo(**values)
+
+
+def read_people(path: str):
+  # (id, SearchInfo) of every valid row, the others are reported and skipped
+  with open(path, newline="", encoding="utf-8-sig") as f:
+    if path.endswith(".jsonl"):
+      rows = (line for line in f if line.strip())
+    else:
+      rows = csv.DictReader(f)
+    for n, row in enumerate(rows, start=1):
+      try:
+        if isinstance(row, str):
+          row = json.loads(row)
+        person = parse_person(row, n)
+      except ValueError as e:
+        print(f"Fila {n} ignorada: {e}", file=sys.stderr)
+        continue
+      yield person
+
+
+def done_ids(path: str) -> set[str]:
+  # Ids already in the output
+  ids = set()
+  if os.path.exists(path):
+    with open(path, encoding="utf-8") as f:
+      for line in f:
+        try:
+          ids.add(json.loads(line)["id"])
+        except (ValueError, KeyError):
+          pass
+  return ids
+
+
+def drop_cut_line(path: str):
+  # Truncates the output after its last newline: a line cut by an
+  # interruption is dropped (and searched again)
+  if not os.path.exists(path):
+    return
+  with open(path, "rb+") as f:
+    end = f.seek(0, os.SEEK_END)
+    while end > 0:
+      start = max(0, end - 65536)
+      f.seek(start)
+      if (i := f.read(end - start).rfind(b"\n")) >= 0:
+        f.truncate(start + i + 1)
+        return
+      end = start
+    f.truncate(0)
+
+
+# Gen of this process, shared by all its searches
+_gen: lib.Gen | None = None
+
+
+def init_worker(sheets: lib.Sheets, max_depth: int | None, max_nodes: int | None,
+                time_budget: float | None, graph: lib.LinkageGraph | None = None,
+                trace: bool = False):
+  global _gen
+  _gen = lib.Gen(sheets, max_depth=max_depth, max_nodes=max_nodes, time_budget=time_budget,
+                 graph=graph, trace=trace)
+
+
+def search(id: str, info: lib.SearchInfo) -> dict:
+  t = time.perf_counter()
+  try:
+    with contextlib.redirect_stdout(io.StringIO()):
+      tree = _gen.get_ancestors(info)
+  except Exception as e:
+    # The rest of the people are still searched
+    return {"id": id, "query": asdict(info), "error": f"{type(e).__name__}: {e}"}
+  seconds = time.perf_counter() - t
+  return {"id": id, "query": asdict(info), "size": lib.get_tree_size(tree),
+          "seconds": round(seconds, 4), "truncated": _gen.truncated, "tree": lib.tree_to_dict(tree, _gen.trace)}
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("excel", nargs="+", help="Excel de cada pueblo")
+  parser.add_argument("-i", "--input", required=True, help="CSV o JSONL con las personas a buscar")
+  parser.add_argument("-o", "--output", required=True, help="JSONL con los resultados")
+  parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1)
+  parser.add_argument("-p", "--pueblos", nargs="*", help="Pueblos en los que buscar (todos por defecto)")
+  parser.add_argument("--max-depth", type=int, default=None, help="Generaciones a buscar")
+  parser.add_argument("--max-nodes", type=int, default=None, help="Personas a buscar por árbol")
+  parser.add_argument("--time-budget", type=float, default=None, help="Segundos por árbol")
+  parser.add_argument("--graph", action="store_true",
+                      help="Enlazar antes todos los bautizos (se guarda en la cache)")
+  parser.add_argument("--trace", action="store_true", help="Incluir el contexto de cada búsqueda")
+  parser.add_argument("--no-cache", action="store_true", help="No usar la cache de Excels procesados")
+  args = parser.parse_args()
+
+  t = time.perf_counter()
+  files = {lib.town_name(path): open(path, "rb").read() for path in args.excel}
+  cache = None if args.no_cache else lib.CorpusCache()
+  corpus = lib.load_corpus(files, cache)
+  sheets = corpus.select(args.pueblos)
+  print(f"Cargados {', '.join(corpus.pueblos)} en {time.perf_counter() - t:.1f}s", file=sys.stderr)
+  graph = None
+  if args.graph:
+    t = time.perf_counter()
+    graph = lib.load_graph(corpus, args.pueblos, cache, args.workers, args.trace)
+    print(f"Grafo de {len(graph)} búsquedas en {time.perf_counter() - t:.1f}s", file=sys.stderr)
+
+  drop_cut_line(args.output)
+  done = done_ids(args.output)
+  people = [(id, info) for id, info in read_people(args.input) if id not in done]
+  print(f"{len(people)} personas por buscar ({len(done)} ya en {args.output})", file=sys.stderr)
+
+  t = time.perf_counter()
+  n = 0
+  with open(args.output, "a", encoding="utf-8") as out:
+    def write(result: dict):
+      nonlocal n
+      out.write(json.dumps(result, ensure_ascii=False) + "\n")
+      out.flush()
+      n += 1
+      if n % 100 == 0 or n == len(people):
+        elapsed = time.perf_counter() - t
+        print(f"{n}/{len(people)} ({n / elapsed:.1f} personas/s)", file=sys.stderr)
+
+    worker_args = (sheets, args.max_depth, args.max_nodes, args.time_budget, graph, args.trace)
+    if args.workers <= 1:
+      init_worker(*worker_args)
+      for id, info in people:
+        write(search(id, info))
+    else:
+      # Each worker keeps its Gen (and memo) for all its searches
+      with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                               initargs=worker_args) as pool:
+        futures = [pool.submit(search, id, info) for id, info in people]
+        for future in as_completed(futures):
+          write(future.result())
+
+  elapsed = time.perf_counter() - t
+  if n:
+    print(f"{n} personas en {elapsed:.1f}s ({n / elapsed:.1f} personas/s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,178 @@
+"""
+Benchmarks and reports over an Excel of Indexación Murcia Genealogía
+
+  python bench.py memory Abaran.xlsx
+  python bench.py match Abaran.xlsx
+  python bench.py scan Abaran.xlsx
+"""
+import argparse
+import gc
+import pickle
+import random
+import re
+import time
+import tracemalloc
+from dataclasses import make_dataclass, fields
+
+import lib
+
+
+def retained_bytes(build) -> int:
+  # Memory still allocated once build() returns (what its result keeps alive)
+  gc.collect()
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  result = build()
+  gc.collect()
+  after = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  del result
+  return after - before
+
+
+def _legacy_class(cls):
+  # Same fields as cls but with a per-instance __dict__ (no slots)
+  return make_dataclass(f"Legacy{cls.__name__}", [f.name for f in fields(cls)])
+
+
+def legacy_layout(sheets: lib.Sheets):
+  # Records as they were originally stored: every record owns its FullName
+  # objects and its own copy of every string
+  LegacyFullName = _legacy_class(lib.FullName)
+  legacy_classes = {lib.Defuncion: _legacy_class(lib.Defuncion),
+                    lib.Bautizo: _legacy_class(lib.Bautizo)}
+
+  def copy_value(v):
+    if isinstance(v, str):
+      return (v + ".")[:-1]
+    if isinstance(v, lib.FullName):
+      return LegacyFullName(*(copy_value(getattr(v, f.name)) for f in fields(v)))
+    return v
+
+  def copy_record(r):
+    return legacy_classes[type(r)](*(copy_value(getattr(r, f.name)) for f in fields(r)))
+
+  return ({year: [copy_record(r) for r in records] for year, records in sheets.baut_by_year.items()},
+          {year: [copy_record(r) for r in records] for year, records in sheets.defu_by_year.items()})
+
+
+def memory(args):
+  sheets = lib.load_sheets(open(args.excel, "rb").read())
+  n_records = sum(len(x) for x in sheets.baut_by_year.values()) + \
+      sum(len(x) for x in sheets.defu_by_year.values())
+  records = (sheets.baut_by_year, sheets.defu_by_year)
+  # A pickle round trip rebuilds the same object graph (sharing included)
+  data = pickle.dumps(records, protocol=pickle.HIGHEST_PROTOCOL)
+  compact = retained_bytes(lambda: pickle.loads(data))
+  legacy = retained_bytes(lambda: legacy_layout(sheets))
+  print(f"{n_records} bautizos y defunciones")
+  print(f"Formato original: {legacy / 2**20:8.1f} MiB ({legacy / n_records:.0f} bytes/registro)")
+  print(f"Formato compacto: {compact / 2**20:8.1f} MiB ({compact / n_records:.0f} bytes/registro)")
+  print(f"Ahorro: {1 - compact / legacy:.0%}")
+
+
+def regex_match_cell(cell: str, candidate: str):
+  # match_cell as it was written with regexes, kept as reference
+  if not cell:
+    return lib.Match.MISSING_INFO
+  if not candidate:
+    return lib.Match.MISSING_INFO
+  if re.match(pattern=f"^{re.escape(candidate)}\\b", string=cell):
+    return lib.Match.TOTAL
+  if re.match(pattern=f"^{re.escape(cell)}\\b", string=candidate):
+    return lib.Match.TOTAL
+  elif candidate in lib.WOMEN_NAME_FOLLOWUPS and re.match(pattern=f"^Maria {re.escape(candidate)}\\b", string=cell):
+    return lib.Match.TOTAL
+  elif cell in lib.WOMEN_NAME_FOLLOWUPS and re.match(pattern=f"^Maria {re.escape(cell)}\\b", string=candidate):
+    return lib.Match.TOTAL
+  elif r := lib.startswith_differ_by_one_char(cell, candidate):
+    return r
+  else:
+    return lib.Match.NO
+
+
+def _cells(r):
+  return [r.nombre, r.apellido_1, r.apellido_2,
+          r.padre.nombre if r.padre else None, r.madre.nombre if r.madre else None]
+
+
+def match(args):
+  sheets = lib.load_sheets(open(args.excel, "rb").read())
+  records = [r for l in sheets.baut_by_year.values() for r in l]
+  random.seed(0)
+  rows = random.sample(records, min(args.rows, len(records)))
+  queries = [_cells(r) for r in random.sample(records, args.queries)]
+  n = len(rows) * len(queries)
+
+  def scan(match_cell):
+    results = []
+    for query in queries:
+      for r in rows:
+        results.append(tuple(match_cell(cell, candidate) for cell, candidate in zip(_cells(r), query)))
+    return results
+
+  lib.name_forms.cache_clear()
+  t = time.perf_counter()
+  expected = scan(regex_match_cell)
+  t_regex = time.perf_counter() - t
+  t = time.perf_counter()
+  results = scan(lib.match_cell)
+  t_forms = time.perf_counter() - t
+  assert results == expected, "match_cell difiere de la version con regex"
+  # find_person over the table: candidates from the postings, matches looked
+  # up by vocabulary id
+  t = time.perf_counter()
+  for query in queries:
+    sheets.baut_table.find_person(lib.SearchInfo(*query), None)
+  t_table = (time.perf_counter() - t) / (len(queries) * len(records))
+  print(f"{n} filas ({len(queries)} busquedas x {len(rows)} registros, 5 celdas por fila)")
+  print(f"regex:  {t_regex / n * 1e6:6.2f} us/fila")
+  print(f"formas: {t_forms / n * 1e6:6.2f} us/fila (x{t_regex / t_forms:.1f})")
+  print(f"tabla:  {t_table * 1e6:6.2f} us/fila (x{t_regex / n / t_table:.1f}, find_person completo)")
+
+
+def scan(args):
+  sheets = lib.load_sheets(open(args.excel, "rb").read())
+  table = sheets.baut_table
+  random.seed(0)
+  # Sibling searches (without nombre) over every year, without the name index
+  queries = [lib.replace(lib.SearchInfo(*_cells(r)), nombre=None)
+             for r in random.sample(table.records, args.queries)]
+  postings, table.postings = table.postings, {}
+  times = {}
+  results = {}
+  for vectorized in (False, True):
+    lib._VECTORIZED_SCAN = vectorized
+    t = time.perf_counter()
+    results[vectorized] = [table.find_person(q, None) for q in queries]
+    times[vectorized] = time.perf_counter() - t
+  table.postings = postings
+  lib._VECTORIZED_SCAN = True
+  assert results[False] == results[True], "El escaneo con NumPy difiere del bucle"
+  n = len(queries) * len(table.records)
+  print(f"{len(queries)} busquedas de hermanos x {len(table.records)} bautizos")
+  print(f"bucle: {n / times[False] / 1e6:6.2f} M filas/s")
+  print(f"numpy: {n / times[True] / 1e6:6.2f} M filas/s (x{times[False] / times[True]:.1f})")
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  subparsers = parser.add_subparsers(required=True)
+  p = subparsers.add_parser("memory", help="Memoria de los registros frente al formato original")
+  p.add_argument("excel")
+  p.set_defaults(func=memory)
+  p = subparsers.add_parser("match", help="Coste por fila de match_cell con y sin regex")
+  p.add_argument("excel")
+  p.add_argument("--rows", type=int, default=5000)
+  p.add_argument("--queries", type=int, default=20)
+  p.set_defaults(func=match)
+  p = subparsers.add_parser("scan", help="Escaneo de una ventana de años con y sin NumPy")
+  p.add_argument("excel")
+  p.add_argument("--queries", type=int, default=50)
+  p.set_defaults(func=scan)
+  args = parser.parse_args()
+  args.func(args)
+
+
+if __name__ == "__main__":
+  main()
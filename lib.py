@@ -1,9 +1,18 @@
+import numpy as np
 import pandas as pd
 import io
+import json
 import re
+import sys
 import datetime
-from dataclasses import dataclass, replace, field
-from collections import defaultdict
+from dataclasses import dataclass, replace, field, fields
+from array import array
+import bisect
+import heapq
+import itertools
+import math
+import time
+from collections import defaultdict, OrderedDict
 from typing import Tuple
 
 
@@ -12,6 +21,12 @@ _LOGGING = False
 
 _VERIFY_SAME_SURNAMES_PER_ROW = False
 
+# Scan the year windows that the name index can't narrow down (e.g. siblings,
+# searched without nombre) with NumPy instead of record by record
+_VECTORIZED_SCAN = True
+# Below this many records the per-record loop is faster
+_VECTORIZED_SCAN_MIN_ROWS = 256
+
 ####################
 
 # When looking for a person based on parents, if the birth and death certificate
@@ -27,33 +42,105 @@ _MAX_AGE_PARENTING = 60
 _MAX_LIFESPAN_AFTER_PARENTING = 60
 
 
-context_map : dict[int, list[str]]= defaultdict(list)
+# Events of trace kept per person searched
+_CONTEXT_MAX_EVENTS = 1000
+
+
+class SearchContext:
+  """
+  Trace of the search of one person, shown when the person is clicked in
+  the tree
+
+  Each event is (message, args): message is a str.format template and args
+  are mostly the records found, so nothing is formatted until the trace is
+  rendered (html() for the page, text() for exports). The events are
+  grouped in paragraphs (see Logger.log_flush). It is kept in the node of
+  the tree (Tree.context), so it lives as long as the tree does. After
+  _CONTEXT_MAX_EVENTS events the rest are dropped.
+  """
+  __slots__ = ("paragraphs", "n_events")
+
+  def __init__(self):
+    self.paragraphs: list[list[tuple[str, tuple]]] = []
+    self.n_events = 0
+
+  def add(self, paragraph: list[tuple[str, tuple]]):
+    room = _CONTEXT_MAX_EVENTS - self.n_events
+    if room <= 0:
+      return
+    if len(paragraph) > room:
+      paragraph = paragraph[:room] + [("(Contexto recortado, demasiado largo)", ())]
+    self.n_events += len(paragraph)
+    self.paragraphs.append(paragraph)
+
+  @staticmethod
+  def render_event(message: str, args: tuple) -> str:
+    return message.format(*args) if args else message
+
+  def html(self) -> list[str]:
+    # One string per paragraph
+    return ["".join(f"{self.render_event(*event)}<br>" for event in paragraph)
+            for paragraph in self.paragraphs]
+
+  def text(self) -> str:
+    return "\n\n".join("\n".join(self.render_event(*event) for event in paragraph)
+                       for paragraph in self.paragraphs)
+
+  def __bool__(self) -> bool:
+    return bool(self.paragraphs)
+
+  def __getstate__(self):
+    return self.paragraphs, self.n_events
+
+  def __setstate__(self, state):
+    self.paragraphs, self.n_events = state
+
 
 class Logger:
   id: int
   nombre_completo: str
-  context: str = ""
 
-  def __init__(self, id:int, nombre_completo:str):
+  def __init__(self, id:int, nombre_completo:str, store: SearchContext | None = None):
     self.id = id
     self.nombre_completo = nombre_completo
+    # Where the trace is written, the node of the person searched
+    self.store = SearchContext() if store is None else store
+    self.paragraph: list[tuple[str, tuple]] = []
 
-  def log_line(self, s:str=""):
+  def log_line(self, s:str="", *args):
     if _LOGGING:
-      print(f"{self.nombre_completo} - {s}")
-    context_map[self.id].append(s+"<br>")
+      print(f"{self.nombre_completo} - {SearchContext.render_event(s, args)}")
+    self.store.add([(s, args)])
 
-  def log_accum(self, s:str=""):
-    self.context+= str(s)+"<br>"
+  def log_accum(self, s="", *args):
+    # s is the template of args, or a record on its own
+    if not isinstance(s, str):
+      s, args = "{}", (s,)
+    self.paragraph.append((s, args))
 
   def log_flush(self):
-    if not self.context:
+    if not self.paragraph:
       return
-    context_map[self.id].append(self.context)
     if _LOGGING:
       print(f"{self.nombre_completo}:")
-      print(self.context.replace("<br>","\n"))
-    self.context = ""
+      print("\n".join(SearchContext.render_event(*event) for event in self.paragraph))
+    self.store.add(self.paragraph)
+    self.paragraph = []
+
+
+class NullLogger:
+  # Logger of the searches without trace, see Gen(trace=False)
+  def log_line(self, s="", *args):
+    pass
+
+  def log_accum(self, s="", *args):
+    pass
+
+  def log_flush(self):
+    pass
+
+
+_NULL_LOGGER = NullLogger()
 
 def log(s:str=""):
   if _LOGGING:
@@ -100,8 +187,16 @@ def extract_year(value):
 import functools
 
 import re
+import contextlib
 import functools
+import gc
+import hashlib
+import os
+import pickle
+import zlib
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from python_calamine import CalamineWorkbook
 from typing import Dict, List, Tuple, Pattern
 import io
 
@@ -124,6 +219,9 @@ class NameCleaner:
         # Compile rewrite rules once
         self.rewrite_rules = self._compile_rewrite_rules()
 
+        # Raw value -> cleaned value, shared by all the columns and sheets
+        self._cleaned: Dict[str, str | None] = {}
+
     @staticmethod
     def _compile_rewrite_rules() -> List[Tuple[Pattern, str]]:
         _REWRITE_RULES = [
@@ -199,73 +297,163 @@ class NameCleaner:
         text = self.remove_de(text)
         text = self.remove_tildes(text)
         text = self.apply_rewrite_rules(text)
-        return text.title()
+        return sys.intern(text.title())
+
+    def clean_cached(self, text: str) -> str:
+        if text not in self._cleaned:
+            self._cleaned[text] = self.clean_names(text)
+        return self._cleaned[text]
 
 def clean_column_name(name: str) -> str:
     return re.sub(r"[^\w]", "", name.replace(" ", "_"))
 
 
-def load_all_sheets_in_colab(data_bytes: bytes) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
-    io_buffer = io.BytesIO(data_bytes)
-    cleaner = NameCleaner()
+# Sheet -> (name columns cleaned with NameCleaner, columns that can't be empty)
+_SHEET_COLUMNS = {
+    "Bautismos": (["Nombre", "Apellido 1", "Apellido 2", "Nombre Padre",
+                   "Nombre Madre", "Abuelos Paternos", "Abuelos Maternos"],
+                  ["Año", "Nombre"]),
+    "Matrimonios": (["Nombre_El", "Apellido 1_El", "Apellido 2_El",
+                     "Nombre_Ella", "Apellido 1_Ella", "Apellido 2_Ella",
+                     "Padres_El", "Padres_Ella"],
+                    ["Año", "Nombre_El", "Nombre_Ella"]),
+    "Defunciones": (["Nombre", "Apellido 1", "Apellido 2",
+                     "Nombre Padre", "Nombre Madre"],
+                    ["Año", "Nombre"]),
+}
+
+
+def convert_cell(value):
+  # Same conversions pandas applies to the cells returned by calamine
+  if isinstance(value, str):
+    return value if value else None
+  if isinstance(value, float) and value.is_integer():
+    return int(value)
+  if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+    return datetime.datetime(value.year, value.month, value.day)
+  return value
+
+
+def process_sheet(sheet_name: str, rows: list[list], cleaner: NameCleaner | None = None) -> pd.DataFrame:
+    # The same rows as scan_sheet, as a DataFrame
+    cleaner = cleaner or NameCleaner()
+    header, rows = rows[0], rows[1:]
+    positions, columns, name_columns, required = _sheet_layout(sheet_name, header)
+    cleaned = []
+    for raw in rows:
+        row = _clean_row([convert_cell(raw[i]) for i in positions], columns, name_columns, cleaner)
+        if all(row[col] is not None for col in required):
+            cleaned.append(row)
+    return pd.DataFrame(cleaned, columns=columns, dtype=object).drop_duplicates()
+
+
+def load_all_sheets_in_colab(data_bytes: bytes, max_workers: int | None = None) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    # Parse the xlsx container only once
+    workbook = CalamineWorkbook.from_filelike(io.BytesIO(data_bytes))
+    rows = {name: workbook.get_sheet_by_name(name).to_python(skip_empty_area=False)
+            for name in _SHEET_COLUMNS}
+    workbook.close()
+
+    if max_workers is None:
+        max_workers = min(len(rows), os.cpu_count() or 1)
+    if max_workers <= 1:
+        # Share the cleaner so names repeated across sheets are cleaned once
+        cleaner = NameCleaner()
+        baut, matr, defu = [process_sheet(name, sheet_rows, cleaner)
+                            for name, sheet_rows in rows.items()]
+    else:
+        # Clean the three sheets at the same time
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(process_sheet, name, sheet_rows)
+                       for name, sheet_rows in rows.items()]
+            baut, matr, defu = [f.result() for f in futures]
+    return baut, matr, defu
 
-    # Define column configurations
-    cols_baut = {
-        "N°": None,
-        "Observaciones": None,
-        "Año": extract_year
-    }
-    name_cols_baut = ["Nombre", "Apellido 1", "Apellido 2", "Nombre Padre",
-                      "Nombre Madre", "Abuelos Paternos", "Abuelos Maternos"]
-    cols_baut.update({col: cleaner.clean_names for col in name_cols_baut})
-
-    cols_matr = {
-        "N°": None,
-        "Observaciones": None,
-        "Año": extract_year
-    }
-    name_cols_matr = ["Nombre_El", "Apellido 1_El", "Apellido 2_El",
-                      "Nombre_Ella", "Apellido 1_Ella", "Apellido 2_Ella",
-                      "Padres_El", "Padres_Ella"]
-    cols_matr.update({col: cleaner.clean_names for col in name_cols_matr})
-
-    cols_defu = {
-        "N°": None,
-        "Observaciones": None,
-        "Año": extract_year
-    }
-    name_cols_defu = ["Nombre", "Apellido 1", "Apellido 2",
-                      "Nombre Padre", "Nombre Madre"]
-    cols_defu.update({col: cleaner.clean_names for col in name_cols_defu})
-
-    # Load and process each sheet
-    baut = pd.read_excel(io_buffer, sheet_name="Bautismos",
-                        converters=cols_baut, usecols=list(cols_baut.keys()),
-                        engine='calamine')
-    baut.rename(columns=clean_column_name, inplace=True)
-    baut = baut.dropna(subset=["Año", "Nombre"]).drop_duplicates()
-
-    # Reset buffer position for next read
-    io_buffer.seek(0)
-    matr = pd.read_excel(io_buffer, sheet_name="Matrimonios",
-                        converters=cols_matr, usecols=list(cols_matr.keys()),
-                         engine='calamine')
-    matr.rename(columns=clean_column_name, inplace=True)
-    matr = matr.dropna(subset=["Año", "Nombre_El", "Nombre_Ella"]).drop_duplicates()
-
-    # Reset buffer position for next read
-    io_buffer.seek(0)
-    defu = pd.read_excel(io_buffer, sheet_name="Defunciones",
-                        converters=cols_defu, usecols=list(cols_defu.keys()),
-                         engine='calamine')
-    defu.rename(columns=clean_column_name, inplace=True)
-    defu = defu.dropna(subset=["Año", "Nombre"]).drop_duplicates()
-
-    # Replace NaN with None consistently
-    for df in [baut, matr, defu]:
-        df.replace({float('nan'): None}, inplace=True)
 
-    return baut, matr, defu
+def _sheet_layout(sheet_name: str, header: list):
+    # Positions of the used columns in the sheet, their clean names, the name
+    # columns and the columns a row can't miss
+    name_cols, required_cols = _SHEET_COLUMNS[sheet_name]
+    wanted = set(["N°", "Observaciones", "Año"] + name_cols)
+    if missing := wanted.difference(header):
+        raise ValueError(f"Columnas no encontradas en la hoja '{sheet_name}': {sorted(missing)}")
+    positions = [i for i, col in enumerate(header) if col in wanted]
+    columns = [clean_column_name(header[i]) for i in positions]
+    name_columns = set(clean_column_name(c) for c in name_cols)
+    required = [clean_column_name(c) for c in required_cols]
+    return positions, columns, name_columns, required
+
+
+def _clean_row(values: tuple, columns: list[str], name_columns: set[str], cleaner: NameCleaner) -> dict:
+    row = {}
+    for col, value in zip(columns, values):
+        if col == "Año":
+            value = extract_year(value)
+            value = None if value is pd.NA else value
+        elif col in name_columns:
+            value = cleaner.clean_cached(value)
+        row[col] = value
+    return row
+
+
+def fingerprint(values) -> int:
+    # Stable between processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(repr(values).encode(), digest_size=8).digest(), "little")
+
+
+@dataclass
+class SheetFingerprints:
+    # Fingerprint of each row as read from the Excel (N°, year and the cells
+    # before cleaning) -> fingerprint of the cleaned row, None if discarded
+    rows: dict[int, int | None]
+    # Fingerprint of each cleaned row -> its record (None if not valid)
+    records: dict[int, object]
+
+
+def scan_sheet(workbook: CalamineWorkbook, sheet_name: str, cleaner: NameCleaner, from_row,
+               pueblo: str | None = None, previous: SheetFingerprints | None = None):
+    """
+    Records of a sheet grouped by year and the fingerprints of its rows. The
+    rows are read one at a time and duplicates are found by fingerprint, so
+    the cells of the sheet are never held in memory as a whole.
+
+    Rows already in previous (same fingerprint) reuse their record without
+    being cleaned again, so updating a sheet only costs its new rows.
+    """
+    rows = workbook.get_sheet_by_name(sheet_name).iter_rows()
+    positions, columns, name_columns, required = _sheet_layout(sheet_name, next(rows, []))
+    row_fingerprints: dict[int, int | None] = {}
+    records: dict[int, object] = {}
+    for raw in rows:
+        values = tuple(convert_cell(raw[i]) for i in positions)
+        raw_fp = fingerprint(values)
+        if raw_fp in row_fingerprints:
+            continue
+        if previous and raw_fp in previous.rows:
+            clean_fp = row_fingerprints[raw_fp] = previous.rows[raw_fp]
+            if clean_fp is not None and clean_fp not in records:
+                records[clean_fp] = previous.records[clean_fp]
+            continue
+        row = _clean_row(values, columns, name_columns, cleaner)
+        if any(row[col] is None for col in required):
+            row_fingerprints[raw_fp] = None
+            continue
+        clean_fp = row_fingerprints[raw_fp] = fingerprint(tuple(row.values()))
+        if clean_fp in records:
+            continue
+        if previous and clean_fp in previous.records:
+            # Only the cleaning removed the difference
+            records[clean_fp] = previous.records[clean_fp]
+            continue
+        if pueblo:
+            row["Pueblo"] = pueblo
+        records[clean_fp] = from_row(row)
+    # Records keep the order of the sheet
+    by_year: dict[int, list] = defaultdict(list)
+    for record in records.values():
+        if record is not None:
+            by_year[record.year].append(record)
+    return dict(sorted(by_year.items())), SheetFingerprints(row_fingerprints, records)
 
 
 ########################
@@ -394,7 +582,7 @@ def get_abuelos(s: str):
   return abuelo_paterno, abuela_paterna
 
 
-from enum import Enum
+from enum import Enum, Flag, auto
 class Match(Enum):
     TOTAL = 1
     MISSING_INFO = 2
@@ -427,11 +615,11 @@ def missing_one_char(str1, str2):
   return diff_found
 
 
-def startswith_differ_by_one_char(cell, candidate):
+def startswith_differ_by_one_char(cell, candidate, cell_first_word=None):
   # If there is more than a 1 char len diff try to split cell in case it has
   # several nouns
   if abs(len(cell) - len(candidate)) > 1:
-    cell = cell.split(" ")[0]
+    cell = cell_first_word if cell_first_word is not None else cell.split(" ")[0]
 
   if missing_one_char(cell, candidate):
     return Match.TOTAL
@@ -458,32 +646,73 @@ def startswith_differ_by_one_char(cell, candidate):
   if diff_count == 1:
     return Match.TOTAL
 
-def match_cell(cell: str, candidate: str):
-  if not cell:
-    return Match.MISSING_INFO
-  if not candidate:
-    return Match.MISSING_INFO
 
-  starts_with_candidate = re.match(pattern=f"^{re.escape(candidate)}\\b",string=cell)
-  if starts_with_candidate:
+def _is_word_char(c: str) -> bool:
+  # Same definition of word character as \w in re
+  return c.isalnum() or c == "_"
+
+
+def word_prefixes(s: str) -> frozenset[str]:
+  # Every prefix p of s followed by a word boundary, i.e. the p for which
+  # re.match(f"^{re.escape(p)}\\b", s) matches
+  prefixes = set()
+  for k in range(1, len(s) + 1):
+    if _is_word_char(s[k - 1]) != (k < len(s) and _is_word_char(s[k])):
+      prefixes.add(s[:k])
+  return frozenset(prefixes)
+
+
+class NameForms:
+  """
+  Forms of a name cell used by match_cell, computed once per distinct name
+
+   - prefixes: the prefixes that end at a word boundary (Juan, Juan Luis)
+   - maria_prefixes: the same for the part after "Maria " (Dolores for
+     Maria Dolores)
+   - first_word: the text before the first space
+  """
+  __slots__ = ("text", "prefixes", "maria_prefixes", "first_word")
+
+  def __init__(self, text: str):
+    self.text = text
+    self.prefixes = word_prefixes(text)
+    self.maria_prefixes = word_prefixes(text[6:]) if text.startswith("Maria ") else frozenset()
+    self.first_word = text.split(" ")[0]
+
+
+@functools.lru_cache(maxsize=65536)
+def name_forms(text: str) -> NameForms:
+  return NameForms(text)
+
+
+def match_forms(cell: NameForms, candidate: NameForms):
+  # Same rules as match_cell over the precomputed forms, without regexes
+  if candidate.text in cell.prefixes:
     return Match.TOTAL
   # TODO review
-  starts_with_cell = re.match(pattern=f"^{re.escape(cell)}\\b",string=candidate)
-  if starts_with_cell:
+  if cell.text in candidate.prefixes:
     return Match.TOTAL
-  elif candidate in WOMEN_NAME_FOLLOWUPS and re.match(pattern=f"^Maria {re.escape(candidate)}\\b",string=cell):
+  elif candidate.text in WOMEN_NAME_FOLLOWUPS and candidate.text in cell.maria_prefixes:
       return Match.TOTAL
-  elif cell in WOMEN_NAME_FOLLOWUPS and re.match(pattern=f"^Maria {re.escape(cell)}\\b",string=candidate):
+  elif cell.text in WOMEN_NAME_FOLLOWUPS and cell.text in candidate.maria_prefixes:
     return Match.TOTAL
   # Si difiere en un solo caracter (mismas posiciones) lo damos por bueno
-  elif r:=startswith_differ_by_one_char(cell, candidate):
+  elif r:=startswith_differ_by_one_char(cell.text, candidate.text, cell.first_word):
     return r
   else:
     return Match.NO
 
 
+def match_cell(cell: str, candidate: str):
+  if not cell:
+    return Match.MISSING_INFO
+  if not candidate:
+    return Match.MISSING_INFO
+  return match_forms(name_forms(cell), name_forms(candidate))
+
+
 def print_row(r):
-  d = r.to_dict()
+  d = r.to_dict() if isinstance(r, pd.Series) else r
   nombre = d["Nombre"]
   apellido_1 = replace_none(d["Apellido_1"],"_")
   apellido_2 = replace_none(d["Apellido_2"],"_")
@@ -506,7 +735,12 @@ def replace_none(v,s):
     return s
   return v
 
-@dataclass
+def intern_name(s: str | None) -> str | None:
+  # Names repeat a lot, keep a single copy of each string
+  return sys.intern(s) if type(s) is str else s
+
+
+@dataclass(slots=True)
 class FullName:
   nombre: str
   apellido_1: str | None = None
@@ -517,6 +751,10 @@ class FullName:
     if not self.nombre:
       pass
       #print(f"Unexpected error, there shouldn't be a FullName object without name: {self.str_explicit()}")
+    self.nombre = intern_name(self.nombre)
+    self.apellido_1 = intern_name(self.apellido_1)
+    self.apellido_2 = intern_name(self.apellido_2)
+    self.origen = intern_name(self.origen)
 
   def __str__(self):
     apellido_1 = replace_none(self.apellido_1, "")
@@ -535,7 +773,7 @@ class FullName:
 
 
 from typing import Optional
-@dataclass
+@dataclass(slots=True)
 class Defuncion:
   # Campos obligatorios para que sea valido
   nombre: str
@@ -548,15 +786,22 @@ class Defuncion:
   fecha: str | None = None
   observaciones: str | None = None # TODO: Buscar patron XX año(s) para saber edad y estimar nacimiento
   n_excel: int | None = None
+  pueblo: str | None = None # Excel (pueblo) del que viene el registro
+
+  def __post_init__(self):
+    self.nombre = intern_name(self.nombre)
+    self.apellido_1 = intern_name(self.apellido_1)
+    self.apellido_2 = intern_name(self.apellido_2)
+    self.pueblo = intern_name(self.pueblo)
 
   @classmethod
-  def defu_from_series(cls, row: pd.Series) -> Optional['Defuncion']:
+  def defu_from_series(cls, row: pd.Series, split=split_name_surnames) -> Optional['Defuncion']:
     nombre = row.get('Nombre')
     year = row.get('Año')
     padre = row.get('Nombre_Padre')
     madre = row.get('Nombre_Madre')
-    padre = split_name_surnames(padre) if padre else None
-    madre = split_name_surnames(madre) if madre else None
+    padre = split(padre) if padre else None
+    madre = split(madre) if madre else None
     apellido_1=row.get('Apellido_1')
     apellido_2=row.get('Apellido_2')
 
@@ -583,7 +828,8 @@ class Defuncion:
       fecha=row.get('Fecha'),
       observaciones=row.get('Observaciones'),
       year=year,
-      n_excel=row.get('N') # For some reason it gets converted to N from N°
+      n_excel=row.get('N'), # For some reason it gets converted to N from N°
+      pueblo=row.get('Pueblo'),
     )
 
   def __str__(self):
@@ -597,10 +843,11 @@ class Defuncion:
     else:
       obs = ""
     n_excel = f" #{self.n_excel}" if self.n_excel else ""
-    return f"{self.nombre} {apellido_1} {apellido_2} ({padre} & {madre}) ({year}){obs}{n_excel}"
+    pueblo = f" [{self.pueblo}]" if self.pueblo else ""
+    return f"{self.nombre} {apellido_1} {apellido_2} ({padre} & {madre}) ({year}){obs}{n_excel}{pueblo}"
 
 
-@dataclass
+@dataclass(slots=True)
 class Bautizo(Defuncion):
   paterno: FullName | None = None # Abuelo paterno
   paterna: FullName | None = None # Abuela paterna
@@ -608,18 +855,18 @@ class Bautizo(Defuncion):
   materna: FullName | None = None # Abuela materna
 
   @classmethod
-  def baut_from_series(cls, row: pd.Series) -> Optional['Bautizo']:
+  def baut_from_series(cls, row: pd.Series, split=split_name_surnames, split_abuelos=get_abuelos) -> Optional['Bautizo']:
     # Reuse defu_from_series to handle the fields in Defuncion
-    obj = Defuncion.defu_from_series(row)
+    obj = Defuncion.defu_from_series(row, split)
     if obj is None:
       return None
 
     # Extract and process additional fields for Bautizo
-    if paternos := get_abuelos(row.get('Abuelos_Paternos')):
+    if paternos := split_abuelos(row.get('Abuelos_Paternos')):
       paterno, paterna = paternos
     else:
       paterno, paterna = None, None
-    if maternos := get_abuelos(row.get('Abuelos_Maternos')):
+    if maternos := split_abuelos(row.get('Abuelos_Maternos')):
       materno, materna = maternos
     else:
       materno, materna = None, None
@@ -654,7 +901,8 @@ class Bautizo(Defuncion):
 
 
     return cls(
-      **obj.__dict__,  # Unpack the fields from the parent class
+      # Unpack the fields from the parent class
+      **{f.name: getattr(obj, f.name) for f in fields(Defuncion)},
       paterno=paterno,
       paterna=paterna,
       materno=materno,
@@ -679,7 +927,71 @@ class Bautizo(Defuncion):
     else:
       obs = ""
     n_excel = f" #{self.n_excel}" if self.n_excel else ""
-    return f"{self.nombre} {apellido_1} {apellido_2} ({padre} & {madre}) AP:({paterno} & {paterna}) AM:({materno} & {materna}) ({year}){obs}{n_excel}"
+    pueblo = f" [{self.pueblo}]" if self.pueblo else ""
+    return f"{self.nombre} {apellido_1} {apellido_2} ({padre} & {madre}) AP:({paterno} & {paterna}) AM:({materno} & {materna}) ({year}){obs}{n_excel}{pueblo}"
+
+@dataclass(slots=True)
+class Matrimonio:
+  year: int
+  nombre_el: str
+  nombre_ella: str
+  apellido_1_el: str | None = None
+  apellido_2_el: str | None = None
+  apellido_1_ella: str | None = None
+  apellido_2_ella: str | None = None
+  padres_el: str | None = None # Celda original, p.ej. Juan Perez y Maria Lopez
+  padres_ella: str | None = None
+  paterno: FullName | None = None # Padre del novio (abuelo paterno de los hijos)
+  paterna: FullName | None = None # Madre del novio
+  materno: FullName | None = None # Padre de la novia
+  materna: FullName | None = None # Madre de la novia
+  observaciones: str | None = None
+  n_excel: int | None = None
+  pueblo: str | None = None
+
+  def __post_init__(self):
+    for f in ("nombre_el", "nombre_ella", "apellido_1_el", "apellido_2_el",
+              "apellido_1_ella", "apellido_2_ella", "pueblo"):
+      setattr(self, f, intern_name(getattr(self, f)))
+
+  @classmethod
+  def matr_from_series(cls, row: pd.Series, split_abuelos=get_abuelos) -> 'Matrimonio':
+    # The parents cells are split once here instead of on every search
+    padres_el = row.get('Padres_El')
+    padres_ella = row.get('Padres_Ella')
+    paterno, paterna = split_abuelos(padres_el) or (None, None)
+    materno, materna = split_abuelos(padres_ella) or (None, None)
+    return cls(
+      year=row.get('Año'),
+      nombre_el=row.get('Nombre_El'),
+      nombre_ella=row.get('Nombre_Ella'),
+      apellido_1_el=row.get('Apellido_1_El'),
+      apellido_2_el=row.get('Apellido_2_El'),
+      apellido_1_ella=row.get('Apellido_1_Ella'),
+      apellido_2_ella=row.get('Apellido_2_Ella'),
+      padres_el=padres_el,
+      padres_ella=padres_ella,
+      paterno=paterno,
+      paterna=paterna,
+      materno=materno,
+      materna=materna,
+      observaciones=row.get('Observaciones'),
+      n_excel=row.get('N'),
+      pueblo=row.get('Pueblo'),
+    )
+
+  def get_abuelos(self):
+    return self.paterno, self.paterna, self.materno, self.materna
+
+  def __str__(self):
+    el = " ".join(replace_none(x, "_") for x in [self.nombre_el, self.apellido_1_el, self.apellido_2_el])
+    ella = " ".join(replace_none(x, "_") for x in [self.nombre_ella, self.apellido_1_ella, self.apellido_2_ella])
+    padres_el = replace_none(self.padres_el, "_")
+    padres_ella = replace_none(self.padres_ella, "_")
+    obs = f" [{self.observaciones}]" if self.observaciones else ""
+    n_excel = f" #{self.n_excel}" if self.n_excel else ""
+    pueblo = f" [{self.pueblo}]" if self.pueblo else ""
+    return f"{el} ({padres_el}) & {ella} ({padres_ella}) ({self.year}){obs}{n_excel}{pueblo}"
 
 import uuid
 @dataclass
@@ -691,6 +1003,8 @@ class Tree:
   n_siblings: int = 0
   inferred_from_siblings: bool = False
   id: int = field(default_factory=uuid.uuid4)
+  # Log context of the search of this person (None for placeholders)
+  context: SearchContext | None = field(default=None, repr=False, compare=False)
 
 
 @dataclass
@@ -715,14 +1029,788 @@ class SearchInfo:
     return f"{self.nombre} | {self.apellido_1} | {apellido_2} ({padre} & {madre})"
 
 
+def deletion_neighbourhood(s: str) -> set[str]:
+  # s and every string obtained by deleting one character of s
+  return {s} | {s[:i] + s[i + 1:] for i in range(len(s))}
+
+
+# How many candidates keep their row of matches in NameVocab
+_VOCAB_MAX_MATCH_ROWS = 2048
+
+
+class _MatchRow(dict):
+  # row[id] = match_cell(name with that id, candidate), filled on first use
+  def __init__(self, forms: list[NameForms | None], candidate: str | None):
+    super().__init__()
+    self.forms = forms
+    # The forms of the query are computed once per search
+    self.candidate = name_forms(candidate) if candidate else None
+    # Ids of the names that match the candidate, see NameVocab.candidates,
+    # and how many names the vocabulary had when they were found
+    self.ids: list[int] | None = None
+    self.ids_size = 0
+    # The whole row as an array, see NameVocab.match_array
+    self.array: np.ndarray | None = None
+
+  def __missing__(self, code: int) -> Match:
+    cell = self.forms[code]
+    if cell is None or self.candidate is None:
+      m = Match.MISSING_INFO
+    else:
+      m = match_forms(cell, self.candidate)
+    self[code] = m
+    return m
+
+
+class NameVocab:
+  """
+  Integer id for every distinct name cell of a corpus (0 is the empty cell)
+
+  A corpus only has a few thousand distinct names, so the result of
+  match_cell is computed once per (name, candidate) pair and then looked up
+  by id during the scans.
+  """
+  def __init__(self):
+    self.names: list[str | None] = [None]
+    self.ids: dict[str, int] = {}
+    # NameForms of each name, computed at ingest time
+    self.forms: list[NameForms | None] = [None]
+    self._rows: OrderedDict[str | None, _MatchRow] = OrderedDict()
+    self._init_index()
+
+  def __getstate__(self):
+    # The forms, match rows and fuzzy index are cheap to rebuild, keep the
+    # cache small
+    return {"names": self.names, "ids": self.ids}
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.forms = [None] + [NameForms(x) for x in self.names[1:]]
+    self._rows = OrderedDict()
+    self._init_index()
+
+  def _init_index(self):
+    # Inverted indexes from a key to the ids of the names, built on first use
+    # and extended when new names are encoded:
+    #  - by_prefix: every word prefix of the name (Juan -> Juan Luis)
+    #  - by_maria_prefix: every word prefix after "Maria " (Dolores -> Maria Dolores)
+    #  - by_deletion: the name and its first word, with and without each one
+    #    of their characters (SymSpell). Two strings within one substitution
+    #    or one insertion/deletion share at least one of these keys
+    self._by_prefix: dict[str, list[int]] = defaultdict(list)
+    self._by_maria_prefix: dict[str, list[int]] = defaultdict(list)
+    self._by_deletion: dict[str, list[int]] = defaultdict(list)
+    self._indexed = 1
+
+  def encode(self, name: str | None) -> int:
+    if not name:
+      return 0
+    code = self.ids.get(name)
+    if code is None:
+      code = self.ids[name] = len(self.names)
+      self.names.append(name)
+      self.forms.append(NameForms(name))
+    return code
+
+  def matches(self, candidate: str | None) -> _MatchRow:
+    row = self._rows.get(candidate)
+    if row is None:
+      row = self._rows[candidate] = _MatchRow(self.forms, candidate)
+      if len(self._rows) > _VOCAB_MAX_MATCH_ROWS:
+        self._rows.popitem(last=False)
+    else:
+      self._rows.move_to_end(candidate)
+    return row
+
+  def _update_index(self):
+    for code in range(self._indexed, len(self.names)):
+      forms = self.forms[code]
+      for p in forms.prefixes:
+        self._by_prefix[p].append(code)
+      for p in forms.maria_prefixes:
+        self._by_maria_prefix[p].append(code)
+      for key in deletion_neighbourhood(forms.text) | deletion_neighbourhood(forms.first_word):
+        self._by_deletion[key].append(code)
+    self._indexed = len(self.names)
+
+  def candidates(self, candidate: str) -> list[int]:
+    """
+    Sorted ids of the names for which match_cell(name, candidate) is not NO,
+    found through the indexes instead of comparing with every name
+    """
+    row = self.matches(candidate)
+    # Names added since the ids were found (e.g. by Sheets.update) may match
+    if row.ids is None or row.ids_size < len(self.names):
+      self._update_index()
+      forms = row.candidate
+      get = self.ids.get
+      ids = set(self._by_prefix.get(forms.text, ()))
+      ids.update(get(p) for p in forms.prefixes)
+      if forms.text in WOMEN_NAME_FOLLOWUPS:
+        ids.update(self._by_maria_prefix.get(forms.text, ()))
+      ids.update(get(p) for p in forms.maria_prefixes if p in WOMEN_NAME_FOLLOWUPS)
+      for key in deletion_neighbourhood(forms.text):
+        ids.update(self._by_deletion.get(key, ()))
+      ids.discard(None)
+      # The keys only narrow down the names, the rules decide
+      row.ids = sorted(code for code in ids if row[code] is not Match.NO)
+      row.ids_size = len(self.names)
+    return row.ids
+
+  def match_array(self, candidate: str | None) -> np.ndarray:
+    # Match value of match_cell(name, candidate) for every id, to be indexed
+    # with a column of ids
+    row = self.matches(candidate)
+    if row.array is None or len(row.array) < len(self.names):
+      if row.candidate is None:
+        a = np.full(len(self.names), Match.MISSING_INFO.value, dtype=np.int8)
+      else:
+        a = np.full(len(self.names), Match.NO.value, dtype=np.int8)
+        a[0] = Match.MISSING_INFO.value
+        for code in self.candidates(candidate):
+          a[code] = row[code].value
+      row.array = a
+    return row.array
+
+
+# Name cells compared by find_person_abstract_v2 and Gen.find_matr
+_PERSON_COLUMNS = {
+    "nombre": lambda r: r.nombre,
+    "apellido_1": lambda r: r.apellido_1,
+    "apellido_2": lambda r: r.apellido_2,
+    "padre": lambda r: r.padre.nombre if r.padre else None,
+    "madre": lambda r: r.madre.nombre if r.madre else None,
+}
+# Columns of _PERSON_COLUMNS with postings in RecordTable
+_INDEXED_COLUMNS = ("nombre", "apellido_1", "apellido_2")
+# Parents of _PERSON_COLUMNS, indexed together for the sibling searches
+_FAMILY_COLUMNS = ("padre", "madre")
+_MATR_COLUMNS = {
+    "nombre_el": lambda r: r.nombre_el,
+    "apellido_1_el": lambda r: r.apellido_1_el,
+    "apellido_2_el": lambda r: r.apellido_2_el,
+    "nombre_ella": lambda r: r.nombre_ella,
+    "apellido_1_ella": lambda r: r.apellido_1_ella,
+    "apellido_2_ella": lambda r: r.apellido_2_ella,
+}
+# Blocking columns of _MATR_COLUMNS, husband's name and surname and wife's name
+_MATR_INDEXED_COLUMNS = ("nombre_el", "apellido_1_el", "nombre_ella")
+
+
+class RecordTable:
+  """
+  Search view over the records of one sheet
+
+  The records are kept in a flat list sorted by year, so that a year range
+  is a contiguous slice, and each compared cell is stored as a NameVocab id.
+  The indexed columns also get postings (id -> positions of the records with
+  that id) so that find_person only checks the records whose cells can match.
+  With family columns, records are also indexed by the pair of parent ids,
+  which is what sibling searches (without nombre) know best.
+  """
+  def __init__(self, by_year: dict[int, list], vocab: NameVocab, columns: dict, indexed=(),
+               family: tuple[str, str] | None = None):
+    self.vocab = vocab
+    self.records: list = []
+    # Sorted years and the offset where the records of each year start. The
+    # records of years[k] are records[offsets[k]:offsets[k + 1]]
+    self.years: list[int] = []
+    self.offsets: list[int] = [0]
+    self.codes: dict[str, array] = {col: array('l') for col in columns}
+    for year, records in sorted(by_year.items()):
+      self.records.extend(records)
+      for col, get_cell in columns.items():
+        self.codes[col].extend(vocab.encode(get_cell(r)) for r in records)
+      self.years.append(year)
+      self.offsets.append(len(self.records))
+    self.postings: dict[str, dict[int, array]] = {}
+    for col in indexed:
+      postings = self.postings[col] = {}
+      for i, code in enumerate(self.codes[col]):
+        if code not in postings:
+          postings[code] = array('l')
+        postings[code].append(i)
+    # (padre id, madre id) -> positions
+    self.family = family
+    self.families: dict[tuple[int, int], array] = {}
+    if family:
+      for i, key in enumerate(zip(self.codes[family[0]], self.codes[family[1]])):
+        if key not in self.families:
+          self.families[key] = array('l')
+        self.families[key].append(i)
+
+  def _span(self, year_range: Tuple[int, int] | None) -> tuple[int, int]:
+    # (start, end) positions of the records in the year range
+    if not year_range:
+      return 0, len(self.records)
+    min_year, max_year = year_range
+    return (self.offsets[bisect.bisect_left(self.years, min_year)],
+            self.offsets[bisect.bisect_right(self.years, max_year)])
+
+  def _positions(self, candidates: dict[str, str | None], year_range: Tuple[int, int] | None):
+    # Positions of the records in the year range, in order. Taken from the
+    # postings of the most selective indexed column (candidates maps column
+    # to the searched value) when that leaves fewer records to check than the
+    # year range itself
+    start, end = self._span(year_range)
+
+    def in_span(p: array) -> array:
+      # Postings are sorted, keep the part inside the span
+      return p[bisect.bisect_left(p, start):bisect.bisect_left(p, end)]
+
+    best = end - start
+    best_postings = None
+    for col, candidate in candidates.items():
+      if not candidate or col not in self.postings:
+        continue
+      postings = self.postings[col]
+      # Empty cells (id 0) are MISSING_INFO, not NO
+      selected = [in_span(p) for code in [0] + self.vocab.candidates(candidate)
+                  if (p := postings.get(code))]
+      n = sum(map(len, selected))
+      if n < best:
+        best, best_postings = n, selected
+    if self.family and all(candidates.get(col) for col in self.family):
+      # Every pair of parents that can match, each of them possibly empty
+      padres, madres = ([0] + self.vocab.candidates(candidates[col]) for col in self.family)
+      families = self.families
+      selected = [in_span(p) for padre in padres for madre in madres
+                  if (p := families.get((padre, madre)))]
+      n = sum(map(len, selected))
+      if n < best:
+        best, best_postings = n, selected
+    if best_postings is None:
+      return range(start, end)
+    return sorted(i for p in best_postings for i in p)
+
+  def _match_window(self, candidates: list[str | None], columns, start: int, end: int):
+    # For the records in [start, end): whether no column is NO, how many are
+    # TOTAL and whether any is MISSING_INFO, all columns at once
+    ok = np.ones(end - start, dtype=bool)
+    n_total = np.zeros(end - start, dtype=np.int8)
+    missing = np.zeros(end - start, dtype=bool)
+    for candidate, col in zip(candidates, columns):
+      # The size of 'l' depends on the platform (4 bytes on Windows)
+      codes = self.codes[col]
+      codes = np.frombuffer(codes, dtype=np.dtype(codes.typecode))[start:end]
+      m = self.vocab.match_array(candidate)[codes]
+      ok &= m != Match.NO.value
+      n_total += m == Match.TOTAL.value
+      missing |= m == Match.MISSING_INFO.value
+    return ok, n_total, missing
+
+  def _take(self, mask: np.ndarray, start: int) -> list:
+    records = self.records
+    return [records[i] for i in (np.flatnonzero(mask) + start).tolist()]
+
+  def find_person(self, info: SearchInfo, year_range: Tuple[int, int] | None) -> 'Findings':
+    # Same logic as the dict version of find_person_abstract_v2
+    candidates = {"nombre": info.nombre, "apellido_1": info.apellido_1, "apellido_2": info.apellido_2,
+                  "padre": info.nombre_padre, "madre": info.nombre_madre}
+    positions = self._positions(candidates, year_range)
+    if _VECTORIZED_SCAN and isinstance(positions, range) and len(positions) >= _VECTORIZED_SCAN_MIN_ROWS:
+      start = positions.start
+      ok, n_total, missing = self._match_window(
+          [info.nombre, info.apellido_1, info.apellido_2, info.nombre_padre, info.nombre_madre],
+          _PERSON_COLUMNS, start, positions.stop)
+      ok &= n_total > 0
+      return Findings(self._take(ok & ~missing, start),
+                      self._take(ok & missing & (n_total == 4), start),
+                      self._take(ok & missing & (n_total == 3), start))
+    vocab = self.vocab
+    nombre = vocab.matches(info.nombre)
+    apellido_1 = vocab.matches(info.apellido_1)
+    apellido_2 = vocab.matches(info.apellido_2)
+    padre = vocab.matches(info.nombre_padre)
+    madre = vocab.matches(info.nombre_madre)
+    c_nombre, c_apellido_1, c_apellido_2, c_padre, c_madre = (
+        self.codes[col] for col in _PERSON_COLUMNS)
+    records = self.records
+    full_matches = []
+    partial_matches = []
+    broad_matches = []
+    for i in positions:
+      name_match = nombre[c_nombre[i]]
+      if name_match is Match.NO:
+        continue
+      surname_1_match = apellido_1[c_apellido_1[i]]
+      if surname_1_match is Match.NO:
+        continue
+      surname_2_match = apellido_2[c_apellido_2[i]]
+      if surname_2_match is Match.NO:
+        continue
+      father_match = padre[c_padre[i]]
+      if father_match is Match.NO:
+        continue
+      mother_match = madre[c_madre[i]]
+      if mother_match is Match.NO:
+        continue
+      this_matches = [name_match, father_match, mother_match, surname_1_match, surname_2_match]
+      if Match.TOTAL in this_matches and Match.MISSING_INFO not in this_matches:
+        full_matches.append(records[i])
+      elif Match.MISSING_INFO in this_matches and Match.TOTAL in this_matches:
+        # If 4 out of 5 fields match
+        if this_matches.count(Match.TOTAL) == 4:
+          partial_matches.append(records[i])
+        # 3/5
+        elif this_matches.count(Match.TOTAL) == 3:
+          broad_matches.append(records[i])
+    return Findings(full_matches, partial_matches, broad_matches)
+
+  def find_matr(self, padre: FullName, madre: FullName, year_range: Tuple[int, int] | None) -> 'Findings':
+    vocab = self.vocab
+    candidates = [padre.nombre, padre.apellido_1, padre.apellido_2,
+                  madre.nombre, madre.apellido_1, madre.apellido_2]
+    positions = self._positions(dict(zip(_MATR_COLUMNS, candidates)), year_range)
+    if _VECTORIZED_SCAN and isinstance(positions, range) and len(positions) >= _VECTORIZED_SCAN_MIN_ROWS:
+      start = positions.start
+      ok, n_total, missing = self._match_window(candidates, _MATR_COLUMNS, start, positions.stop)
+      ok &= n_total > 0
+      return Findings(self._take(ok & ~missing, start),
+                      self._take(ok & missing & (n_total >= 4), start),
+                      self._take(ok & missing & (n_total == 3), start))
+    rows = [vocab.matches(x) for x in candidates]
+    codes = [self.codes[col] for col in _MATR_COLUMNS]
+    columns = list(zip(rows, codes))
+    records = self.records
+    full_matches = []
+    partial_matches = []
+    broad_matches = []
+    for i in positions:
+      this_matches = []
+      for row, c in columns:
+        m = row[c[i]]
+        if m is Match.NO:
+          break
+        this_matches.append(m)
+      else:
+        if Match.TOTAL in this_matches and Match.MISSING_INFO not in this_matches:
+          full_matches.append(records[i])
+        elif Match.MISSING_INFO in this_matches and Match.TOTAL in this_matches:
+          # 4/6 campos
+          # Apellido 2 casi siempre esta vacio en madre y padre asi que no tiene
+          # sentido pedir mas de 4
+          if this_matches.count(Match.TOTAL) >= 4:
+            partial_matches.append(records[i])
+          elif this_matches.count(Match.TOTAL) >= 3:
+            broad_matches.append(records[i])
+    return Findings(full_matches, partial_matches, broad_matches)
+
+
 @dataclass
 class Sheets:
   baut_by_year: dict[int, list[Bautizo]]
   defu_by_year: dict[int, list[Defuncion]]
-  matr_by_year: dict[int, dict]
+  matr_by_year: dict[int, list[Matrimonio]]
+  # Sheet name -> SheetFingerprints, when built from the Excel by stream_sheets
+  fingerprints: dict[str, SheetFingerprints] | None = field(default=None, repr=False, compare=False)
+  # Derived from the records by reindex()
+  vocab: NameVocab = field(init=False, repr=False, compare=False)
+  baut_table: RecordTable = field(init=False, repr=False, compare=False)
+  defu_table: RecordTable = field(init=False, repr=False, compare=False)
+  matr_table: RecordTable = field(init=False, repr=False, compare=False)
+
+  def __post_init__(self):
+    # Searches go through the years in order
+    self.baut_by_year = dict(sorted(self.baut_by_year.items()))
+    self.defu_by_year = dict(sorted(self.defu_by_year.items()))
+    self.matr_by_year = dict(sorted(self.matr_by_year.items()))
+    self.reindex()
+
+  def reindex(self, vocab: NameVocab | None = None):
+    # Must be called after modifying the records. The vocabulary of the
+    # previous records can be kept, names are only ever added to it
+    self.vocab = NameVocab() if vocab is None else vocab
+    self.baut_table = RecordTable(self.baut_by_year, self.vocab, _PERSON_COLUMNS, _INDEXED_COLUMNS,
+                                  _FAMILY_COLUMNS)
+    self.defu_table = RecordTable(self.defu_by_year, self.vocab, _PERSON_COLUMNS, _INDEXED_COLUMNS,
+                                  _FAMILY_COLUMNS)
+    self.matr_table = RecordTable(self.matr_by_year, self.vocab, _MATR_COLUMNS, _MATR_INDEXED_COLUMNS)
+
+  def update(self, data_bytes: bytes, pueblo: str | None = None) -> dict[str, set[int]]:
+    """
+    Brings the records up to date with a new version of their Excel
 
+    Only the rows whose fingerprint is not in the previous version are
+    cleaned and built, the records of the removed rows are dropped and the
+    tables are indexed again with the same vocabulary. Returns the years
+    whose records changed in each sheet (sheet name -> years), see
+    Gen.invalidate.
+    """
+    if self.fingerprints is None:
+      # Built without fingerprints (from DataFrames), everything is new
+      new = stream_sheets(data_bytes, pueblo)
+      changed = {sheet_name: set(getattr(self, attr)) | set(getattr(new, attr))
+                 for sheet_name, attr in _SHEET_ATTRIBUTES}
+      self.fingerprints = new.fingerprints
+      self.baut_by_year, self.matr_by_year, self.defu_by_year = new.baut_by_year, new.matr_by_year, new.defu_by_year
+      self.reindex()
+      return changed
+    workbook = CalamineWorkbook.from_filelike(io.BytesIO(data_bytes))
+    cleaner = NameCleaner()
+    changed = {}
+    for (sheet_name, attr), from_row in zip(_SHEET_ATTRIBUTES, _record_builders()):
+      by_year, self.fingerprints[sheet_name] = scan_sheet(
+          workbook, sheet_name, cleaner, from_row, pueblo, self.fingerprints[sheet_name])
+      old = getattr(self, attr)
+      changed[sheet_name] = {year for year in old.keys() | by_year.keys()
+                             if list(map(id, old.get(year, ()))) != list(map(id, by_year.get(year, ())))}
+      setattr(self, attr, by_year)
+    workbook.close()
+    if any(changed.values()):
+      self.reindex(self.vocab)
+    return changed
+
+
+# Sheet of the Excel and attribute of Sheets, in the order of _record_builders
+_SHEET_ATTRIBUTES = (("Bautismos", "baut_by_year"), ("Matrimonios", "matr_by_year"),
+                     ("Defunciones", "defu_by_year"))
+
+
+def _record_builders():
+  # Parent and grandparent cells repeat a lot, so split each distinct value
+  # once. The resulting FullName objects are shared between records and must
+  # not be modified
+  split = functools.lru_cache(maxsize=None)(split_name_surnames)
+  split_abuelos = functools.lru_cache(maxsize=None)(get_abuelos)
+  baut = functools.partial(Bautizo.baut_from_series, split=split, split_abuelos=split_abuelos)
+  defu = functools.partial(Defuncion.defu_from_series, split=split)
+  matr = functools.partial(Matrimonio.matr_from_series, split_abuelos=split_abuelos)
+  return baut, matr, defu
+
+
+def build_sheets(baut_all: pd.DataFrame, matr_all: pd.DataFrame, defu_all: pd.DataFrame,
+                 pueblo: str | None = None) -> Sheets:
+  # The same Sheets as stream_sheets from the DataFrames of
+  # load_all_sheets_in_colab, without the fingerprints of the rows
+  by_year = {}
+  for (_, attr), df, from_row in zip(_SHEET_ATTRIBUTES, (baut_all, matr_all, defu_all), _record_builders()):
+    buckets: dict[int, list] = defaultdict(list)
+    for row in df.to_dict('records'):
+      if pueblo:
+        row["Pueblo"] = pueblo
+      if x := from_row(row):
+        buckets[row["Año"]].append(x)
+    by_year[attr] = dict(sorted(buckets.items()))
+  return Sheets(**by_year)
+
+
+def _scan_sheet_in_worker(data_bytes: bytes, sheet_name: str, pueblo: str | None):
+  # Each worker opens the workbook and cleans one sheet
+  workbook = CalamineWorkbook.from_filelike(io.BytesIO(data_bytes))
+  from_row = _record_builders()[[name for name, _ in _SHEET_ATTRIBUTES].index(sheet_name)]
+  try:
+    return scan_sheet(workbook, sheet_name, NameCleaner(), from_row, pueblo)
+  finally:
+    workbook.close()
+
+
+def stream_sheets(data_bytes: bytes, pueblo: str | None = None, max_workers: int | None = None) -> Sheets:
+  # Build the records straight from the workbook rows, without DataFrames,
+  # cleaning the three sheets at the same time when there are several CPUs.
+  # The fingerprints of the rows are kept for Sheets.update
+  if max_workers is None:
+    max_workers = min(len(_SHEET_ATTRIBUTES), os.cpu_count() or 1)
+  by_year, fingerprints = {}, {}
+  if max_workers <= 1:
+    # Share the cleaner so names repeated across sheets are cleaned once
+    workbook = CalamineWorkbook.from_filelike(io.BytesIO(data_bytes))
+    cleaner = NameCleaner()
+    for (sheet_name, attr), from_row in zip(_SHEET_ATTRIBUTES, _record_builders()):
+      by_year[attr], fingerprints[sheet_name] = scan_sheet(workbook, sheet_name, cleaner, from_row, pueblo)
+    workbook.close()
+  else:
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+      futures = {sheet_name: pool.submit(_scan_sheet_in_worker, data_bytes, sheet_name, pueblo)
+                 for sheet_name, _ in _SHEET_ATTRIBUTES}
+      for sheet_name, attr in _SHEET_ATTRIBUTES:
+        by_year[attr], fingerprints[sheet_name] = futures[sheet_name].result()
+  return Sheets(**by_year, fingerprints=fingerprints)
+
+
+####################
+
+# Bump when the records or the cleaning/splitting code change in a way that
+# makes the cached corpora (or graphs) stale
+_CACHE_VERSION = 9
+_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# A .tmp file older than this was left by a put that didn't finish
+_CACHE_TMP_MAX_AGE = 60 * 60
+
+
+def rules_fingerprint() -> str:
+  # Editing the rewrite rules or the compound names also invalidates the cache
+  h = hashlib.sha256(f"v{_CACHE_VERSION}".encode())
+  for regex, replacement in NameCleaner._compile_rewrite_rules():
+    h.update(f"{regex.pattern}->{replacement};".encode())
+  h.update(",".join(sorted(NAME_FOLLOWUPS)).encode())
+  return h.hexdigest()[:16]
+
+
+def workbook_key(data_bytes: bytes, pueblo: str | None = None) -> str:
+  h = hashlib.sha256(data_bytes)
+  # The records are tagged with the town they come from
+  if pueblo:
+    h.update(pueblo.encode())
+  return h.hexdigest()[:32]
+
+
+class CorpusCache:
+  """
+  On-disk cache of processed workbooks
+
+  Each entry is a fully built Sheets, pickled and compressed, stored under
+  the hash of the uploaded bytes plus the fingerprint of the cleaning rules.
+  The linkage graph of a set of towns is stored the same way, with the
+  .graph suffix. The file modification time is used as the last access time so that the
+  least recently used entries are evicted once the cache exceeds max_bytes.
+  """
+  def __init__(self, directory: str | None = None, max_bytes: int = _CACHE_MAX_BYTES):
+    self.directory = directory or os.environ.get("GENREMUR_CACHE_DIR") or \
+        os.path.join(os.path.expanduser("~"), ".cache", "genremur")
+    self.max_bytes = max_bytes
+    os.makedirs(self.directory, exist_ok=True)
+
+  def key(self, data_bytes: bytes, pueblo: str | None = None) -> str:
+    return workbook_key(data_bytes, pueblo) + "-" + rules_fingerprint()
+
+  def _path(self, key: str, suffix: str) -> str:
+    return os.path.join(self.directory, f"{key}.{suffix}")
+
+  def get(self, key: str, suffix: str = "sheets"):
+    path = self._path(key, suffix)
+    # Unpickling creates hundreds of thousands of objects, pause the garbage
+    # collector meanwhile or it takes most of the load time
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+      with open(path, "rb") as f:
+        value = pickle.loads(zlib.decompress(f.read()))
+    except FileNotFoundError:
+      return None
+    except Exception as e:
+      log(f"Entrada de cache corrupta {path}: {e}")
+      self._remove(path)
+      return None
+    finally:
+      if gc_enabled:
+        gc.enable()
+    # Mark as recently used, unless another process evicted it meanwhile
+    try:
+      os.utime(path)
+    except FileNotFoundError:
+      pass
+    return value
+
+  def put(self, key: str, value, suffix: str = "sheets"):
+    path = self._path(key, suffix)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+      with open(tmp_path, "wb") as f:
+        f.write(zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+      os.replace(tmp_path, path)
+    except BaseException:
+      self._remove(tmp_path)
+      raise
+    self.evict()
+
+  def evict(self):
+    # The .tmp files being written count towards max_bytes, the ones left by
+    # a process that died while writing are removed
+    entries = []
+    total = 0
+    now = time.time()
+    for name in os.listdir(self.directory):
+      if not name.endswith((".sheets", ".graph", ".tmp")):
+        continue
+      path = os.path.join(self.directory, name)
+      try:
+        st = os.stat(path)
+      except FileNotFoundError:
+        continue
+      if name.endswith(".tmp"):
+        if now - st.st_mtime > _CACHE_TMP_MAX_AGE:
+          self._remove(path)
+        else:
+          total += st.st_size
+        continue
+      entries.append((st.st_mtime, st.st_size, name))
+      total += st.st_size
+    # Oldest first
+    for _, size, name in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      self._remove(os.path.join(self.directory, name))
+      total -= size
+
+  def _remove(self, path: str):
+    try:
+      os.remove(path)
+    except FileNotFoundError:
+      pass
+
+
+def load_sheets(data_bytes: bytes, cache: CorpusCache | None = None, pueblo: str | None = None,
+                max_workers: int | None = None) -> Sheets:
+  key = cache.key(data_bytes, pueblo) if cache else None
+  if cache and (sheets := cache.get(key)):
+    return sheets
+  sheets = stream_sheets(data_bytes, pueblo, max_workers)
+  if cache:
+    cache.put(key, sheets)
+  return sheets
+
+
+####################
+
+def merge_sheets(all_sheets: list[Sheets]) -> Sheets:
+  def merge(tables: list[dict[int, list]]) -> dict[int, list]:
+    merged: dict[int, list] = defaultdict(list)
+    for table in tables:
+      for year, records in table.items():
+        merged[year].extend(records)
+    return dict(sorted(merged.items()))
+  return Sheets(
+      baut_by_year=merge([s.baut_by_year for s in all_sheets]),
+      matr_by_year=merge([s.matr_by_year for s in all_sheets]),
+      defu_by_year=merge([s.defu_by_year for s in all_sheets]))
+
+
+# Merged Sheets kept by a Corpus, one per combination of towns
+_MERGED_MAX_ENTRIES = 4
+
+
+class Corpus:
+  """
+  Records of several towns (one Excel per town)
+
+  Each town keeps its own Sheets so that searching a single town costs the
+  same as before. Searching several towns uses a merged Sheets, built the
+  first time that combination of towns is requested. Only the last
+  _MERGED_MAX_ENTRIES combinations are kept.
+  """
+  def __init__(self, towns: dict[str, Sheets] | None = None, keys: dict[str, str] | None = None):
+    self.towns: dict[str, Sheets] = dict(towns or {})
+    # pueblo -> workbook_key of its Excel, when it is known
+    self.keys: dict[str, str] = dict(keys or {})
+    self._merged: OrderedDict[tuple[str, ...], Sheets] = OrderedDict()
+
+  @property
+  def pueblos(self) -> list[str]:
+    return sorted(self.towns)
+
+  def add(self, pueblo: str, sheets: Sheets, key: str | None = None):
+    self.towns[pueblo] = sheets
+    self.keys.pop(pueblo, None)
+    if key:
+      self.keys[pueblo] = key
+    self._merged.clear()
+
+  def update(self, pueblo: str, data_bytes: bytes, cache: CorpusCache | None = None) -> dict[str, set[int]]:
+    # New version of the Excel of a town, see Sheets.update
+    sheets = self.towns[pueblo]
+    changed = sheets.update(data_bytes, pueblo)
+    self.keys[pueblo] = workbook_key(data_bytes, pueblo)
+    if any(changed.values()):
+      self._merged.clear()
+    if cache:
+      cache.put(cache.key(data_bytes, pueblo), sheets)
+    return changed
+
+  def _names(self, pueblos: str | list[str] | None) -> tuple[str, ...]:
+    if pueblos is None:
+      names = tuple(self.pueblos)
+    elif isinstance(pueblos, str):
+      names = (pueblos,)
+    else:
+      names = tuple(sorted(set(pueblos)))
+    if unknown := [x for x in names if x not in self.towns]:
+      raise ValueError(f"Pueblos no cargados: {unknown}")
+    return names
+
+  def key(self, pueblos: str | list[str] | None = None) -> str | None:
+    # Identifies the records of a selection of towns (None if the Excel of
+    # any of them is not known)
+    names = self._names(pueblos)
+    if any(x not in self.keys for x in names):
+      return None
+    return hashlib.sha256("|".join(self.keys[x] for x in names).encode()).hexdigest()[:32]
+
+  def select(self, pueblos: str | list[str] | None = None) -> Sheets:
+    names = self._names(pueblos)
+    if len(names) == 1:
+      return self.towns[names[0]]
+    if names in self._merged:
+      self._merged.move_to_end(names)
+    else:
+      self._merged[names] = merge_sheets([self.towns[x] for x in names])
+      if len(self._merged) > _MERGED_MAX_ENTRIES:
+        self._merged.popitem(last=False)
+    return self._merged[names]
+
+
+def town_name(filename: str) -> str:
+  # Abarán.xlsx -> Abarán
+  return os.path.splitext(os.path.basename(filename))[0]
+
+
+def _load_town(pueblo: str, data_bytes: bytes, cache: CorpusCache | None) -> Sheets:
+  # Single process loader, the towns are loaded in parallel instead
+  return load_sheets(data_bytes, cache, pueblo, max_workers=1)
+
+
+def load_corpus(files: dict[str, bytes], cache: CorpusCache | None = None,
+                max_workers: int | None = None) -> Corpus:
+  # files: pueblo -> contents of its Excel
+  if max_workers is None:
+    max_workers = min(len(files), os.cpu_count() or 1)
+  keys = {pueblo: workbook_key(data_bytes, pueblo) for pueblo, data_bytes in files.items()}
+  if len(files) == 1:
+    # A single town cleans its sheets in parallel instead
+    (pueblo, data_bytes), = files.items()
+    return Corpus({pueblo: load_sheets(data_bytes, cache, pueblo)}, keys)
+  if max_workers <= 1:
+    return Corpus({pueblo: _load_town(pueblo, data_bytes, cache)
+                   for pueblo, data_bytes in files.items()}, keys)
+  with ProcessPoolExecutor(max_workers=max_workers) as pool:
+    futures = {pueblo: pool.submit(_load_town, pueblo, data_bytes, cache)
+               for pueblo, data_bytes in files.items()}
+    return Corpus({pueblo: f.result() for pueblo, f in futures.items()}, keys)
+
+
+# (first, last) year of the records read from each sheet, in the order of
+# _SHEET_ATTRIBUTES
+YearSpans = tuple[tuple[float, float], ...]
+_ALL_YEARS = (-math.inf, math.inf)
+
+
+def search_years(info: SearchInfo, tree: Tree) -> YearSpans:
+  # Years read by Gen.resolve_node(info), which returned tree: baptism and
+  # siblings, the marriage of the parents before the baptism and the death.
+  # Without year_child every year is read, and without a baptism so is
+  # every year of marriages
+  if not info.year_child:
+    return _ALL_YEARS, _ALL_YEARS, _ALL_YEARS
+  first, last = get_parenting_age_birth_range(info.year_child)
+  if tree.baut and tree.baut.year or tree.inferred_from_siblings:
+    matr = (first - _MAX_AGE_PARENTING + _MIN_AGE_PARENTING, last)
+  else:
+    matr = _ALL_YEARS
+  return (first, last), matr, (info.year_child - 1, info.year_child + _MAX_LIFESPAN_AFTER_PARENTING)
 
 
+def merge_years(a: YearSpans, b: YearSpans) -> YearSpans:
+  return tuple((min(x[0], y[0]), max(x[1], y[1])) for x, y in zip(a, b))
+
+
+def reads_changed_years(spans: YearSpans, changed: list[list[int]]) -> bool:
+  # changed: sorted years that changed in each sheet
+  for (first, last), years in zip(spans, changed):
+    i = bisect.bisect_left(years, first)
+    if i < len(years) and years[i] <= last:
+      return True
+  return False
+
 
 def get_parenting_age_birth_range(year_child):
   # E.g. Child born in 1800 -> Parents borin in [1740 - 1784]
@@ -782,7 +1870,9 @@ class Findings:
   partial_matches: list
   broad_matches: list
 
-def find_person_abstract_v2(sheet: dict, info: SearchInfo, year_range:Tuple[int,int]|None):
+def find_person_abstract_v2(sheet: dict | RecordTable, info: SearchInfo, year_range:Tuple[int,int]|None):
+  if isinstance(sheet, RecordTable):
+    return sheet.find_person(info, year_range)
   full_matches = []
   partial_matches = []
   broad_matches = []
@@ -845,33 +1935,139 @@ def get_person_from_findings(fin: Findings, logger: Logger, name_record: str):
   if len(records) == 0:
     return None
   elif len(records) == 1:
-    logger.log_accum(f"{name_record.title()} encontrado{broad_match}:")
+    logger.log_accum("{} encontrado{}:", name_record.title(), broad_match)
     logger.log_accum(records[0])
     logger.log_flush()
     return records[0]
   else:
-    logger.log_accum(f"Varios {name_record}/s encontrados{broad_match}, no se ha elegido ninguno.")
+    logger.log_accum("Varios {}/s encontrados{}, no se ha elegido ninguno.", name_record, broad_match)
     for r in records:
-      logger.log_accum(f" → {r}")
+      logger.log_accum(" → {}", r)
     logger.log_flush()
     return None
 
+@dataclass(slots=True)
+class FoundNode:
+  # A person of the tree, yielded by Gen.iter_ancestors once resolved
+  tree: Tree
+  # Node it is the padre or madre of (None for the person searched)
+  child: Tree | None
+  side: str | None
+  depth: int
+  # Parents still to be searched, their nodes in tree are placeholders
+  # until then. Empty for a tree taken from the memo (already complete)
+  pending: tuple[str, ...]
+
+
+# How many solved searches (subtrees) a Gen keeps for reuse
+_MEMO_MAX_ENTRIES = 4096
+# Processes that search the ancestors of the same generation at the same time
+# (1 searches one person after another in this process)
+_SEARCH_WORKERS = 1
+# Generations searched above the person (None for no limit)
+_MAX_SEARCH_DEPTH = None
+# People searched (records looked up) per tree (None for no limit)
+_MAX_SEARCH_NODES = None
+# Seconds per tree, checked between searches (None for no limit)
+_SEARCH_TIME_BUDGET = None
+
+
 class Gen:
   sheets: Sheets
-  def __init__(self, sheets):
+  def __init__(self, sheets: Sheets | Corpus, pueblos: str | list[str] | None = None,
+               memo_size: int = _MEMO_MAX_ENTRIES, workers: int = _SEARCH_WORKERS,
+               max_depth: int | None = _MAX_SEARCH_DEPTH, max_nodes: int | None = _MAX_SEARCH_NODES,
+               time_budget: float | None = _SEARCH_TIME_BUDGET, graph: "LinkageGraph | None" = None,
+               trace: bool = True):
+    # With a Corpus, only the given towns are searched (all of them by default)
+    if isinstance(sheets, Corpus):
+      sheets = sheets.select(pueblos)
     self.sheets = sheets
+    self.workers = workers
+    self.max_depth = max_depth
+    self.max_nodes = max_nodes
+    self.time_budget = time_budget
+    # Whether the trees keep the trace of each search (Tree.context)
+    self.trace = trace
+    # Whether the last get_ancestors ran out of budget
+    self.truncated = False
+    # Searches resolved beforehand, see LinkageGraph
+    self.graph = graph
+    # Normalized SearchInfo -> Tree. The same ancestor is reached through
+    # several paths (pedigree collapse) and from the searches of relatives,
+    # so each one is only searched once. LRU once memo_size is reached
+    self.memo: OrderedDict[tuple, Tree] = OrderedDict()
+    # Same keys -> years of the records read to build the tree
+    self.memo_years: dict[tuple, YearSpans] = {}
+    self.memo_size = memo_size
+    self.memo_hits = 0
+    self.memo_misses = 0
+    # Search workers (with workers > 1), started by the first search and
+    # kept until close(): starting them sends them the whole Sheets
+    self._pool: ProcessPoolExecutor | None = None
+
+  def _search_pool(self) -> ProcessPoolExecutor:
+    if self._pool is None:
+      self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_search_worker,
+                                       initargs=(self.sheets, self.trace))
+    return self._pool
+
+  def close(self):
+    # Stops the search workers, the next search starts them again
+    if self._pool is not None:
+      self._pool.shutdown(cancel_futures=True)
+      self._pool = None
+
+  @staticmethod
+  def memo_key(info: SearchInfo) -> tuple:
+    # Empty strings and None are the same missing field
+    return tuple(getattr(info, f.name) or None for f in fields(SearchInfo))
+
+  def _node_key(self, info: SearchInfo, depth: int) -> tuple:
+    # With max_depth, the same search yields a smaller tree the deeper it is
+    remaining = None if self.max_depth is None else self.max_depth - depth
+    return self.memo_key(info), remaining
+
+  def _memo_get(self, key: tuple) -> Tree | None:
+    tree = self.memo.get(key)
+    if tree is not None:
+      self.memo_hits += 1
+      self.memo.move_to_end(key)
+    return tree
+
+  def _memo_put(self, key: tuple, tree: Tree, years: YearSpans):
+    self.memo[key] = tree
+    self.memo_years[key] = years
+    if len(self.memo) > self.memo_size:
+      old_key, _ = self.memo.popitem(last=False)
+      del self.memo_years[old_key]
+
+  def invalidate(self, changed: dict[str, set[int]]) -> int:
+    # Forgets the trees that read records of the years that changed in each
+    # sheet (see Sheets.update). Returns how many were forgotten
+    changed = _sorted_changes(changed)
+    stale = [key for key, years in self.memo_years.items() if reads_changed_years(years, changed)]
+    for key in stale:
+      del self.memo[key]
+      del self.memo_years[key]
+    if self.graph is not None:
+      self.graph.invalidate(changed)
+    if any(changed):
+      # The workers have a copy of the old sheets
+      self.close()
+    return len(stale)
 
   def find_person(self,info: SearchInfo):
     year_range = None
     if info.year_child:
       year_range = get_parenting_age_birth_range(info.year_child)
-    return find_person_abstract_v2(self.sheets.baut_by_year, info, year_range)
+    return find_person_abstract_v2(self.sheets.baut_table, info, year_range)
 
   def find_person_defu(self, info: SearchInfo):
     year_range = None
     if info.year_child:
       year_range = (info.year_child-1, info.year_child+_MAX_LIFESPAN_AFTER_PARENTING)
-    return find_person_abstract_v2(self.sheets.defu_by_year, info, year_range)
+    return find_person_abstract_v2(self.sheets.defu_table, info, year_range)
 
   def find_matr(self,padre:FullName, madre: FullName, year_child):
     year_range = None
@@ -882,62 +2078,26 @@ class Gen:
           year_child-_MAX_AGE_PARENTING+_MIN_AGE_PARENTING
           ,year_child)
 
-    full_matches = []
-    partial_matches = []
-    broad_matches = []
+    return self.sheets.matr_table.find_matr(padre, madre, year_range)
 
-    for year,baut in self.sheets.matr_by_year.items():
-      if year_range:
-        min_year, max_year = year_range
-        if not (min_year <= year <= max_year):
-          continue
 
-      for r in baut:
-        man_name_match = match_cell(r["Nombre_El"], padre.nombre)
-        if Match.NO == man_name_match:
-          continue
-        man_surnames_match = [
-            match_cell(r["Apellido_1_El"], padre.apellido_1),
-             (match_cell(r["Apellido_2_El"], padre.apellido_2))]
-        if Match.NO in man_surnames_match:
-          continue
-        woman_name_match = match_cell(r["Nombre_Ella"], madre.nombre)
-        if Match.NO == woman_name_match:
-          continue
-        woman_surnames_match = [
-            match_cell(r["Apellido_1_Ella"], madre.apellido_1),
-             (match_cell(r["Apellido_2_Ella"], madre.apellido_2))]
-        this_matches = [man_name_match, woman_name_match]+man_surnames_match+woman_surnames_match
-
-        if Match.NO in this_matches:
-          continue
-        if Match.TOTAL in this_matches and Match.MISSING_INFO not in this_matches:
-          full_matches.append(r)
-        elif Match.MISSING_INFO in this_matches and Match.TOTAL in this_matches:
-          # 4/6 campos
-          # Apellido 2 casi siempre esta vacio en madre y padre asi que no tiene
-          # sentido pedir mas de 4
-          if this_matches.count(Match.TOTAL) >= 4:
-            partial_matches.append(r)
-          elif this_matches.count(Match.TOTAL) >= 3:
-            broad_matches.append(r)
-    return Findings(full_matches, partial_matches, broad_matches)
-
-
-  def get_tree_parent_from_baut_v2(self, abuelo: FullName, abuela: FullName,parent: FullName, year:int):
-    padre_info = SearchInfo(
+  @staticmethod
+  def parent_info(abuelo: FullName, abuela: FullName, parent: FullName, year: int) -> SearchInfo:
+    return SearchInfo(
         nombre=parent.nombre,
         apellido_1=parent.apellido_1 or abuelo.apellido_1,
         apellido_2=parent.apellido_2 or abuela.apellido_1,
         nombre_padre=abuelo.nombre,
         nombre_madre=abuela.nombre,
         year_child=year)
-    return self.get_ancestors(padre_info)
+
+  def get_tree_parent_from_baut_v2(self, abuelo: FullName, abuela: FullName,parent: FullName, year:int):
+    return self.get_ancestors(self.parent_info(abuelo, abuela, parent, year))
 
   def infer_from_siblings(self, siblings, logger):
     sets_of_abuelos = get_sets_abuelos(siblings)
     if len(sets_of_abuelos.keys()) == 1:
-      logger.log_accum(f"Deducido datos de potencial hermano: {siblings[0].nombre}. (Todos los candidatos tienen los mismos abuelos)")
+      logger.log_accum("Deducido datos de potencial hermano: {}. (Todos los candidatos tienen los mismos abuelos)", siblings[0].nombre)
       return siblings[0]
     else:
       list_abuelos = sorted(sets_of_abuelos.items(),key=lambda x:x[0])
@@ -952,18 +2112,159 @@ class Gen:
           break
 
       if not same_abuelos:
-        logger.log_accum(f"No se pueden deducir datos de los candidatos pues no todos tienen los mismos abuelos.")
+        logger.log_accum("No se pueden deducir datos de los candidatos pues no todos tienen los mismos abuelos.")
       else:
         inferred_from_siblings = True
-        logger.log_accum(f"Deducido datos de potenticial hermano: {siblings[0]}.")
+        logger.log_accum("Deducido datos de potenticial hermano: {}.", siblings[0])
         logger.log_accum("Los abuelos de los hermanos difieren solo en un nombre.")
         return siblings[0]
       for s,n in list_abuelos:
-        logger.log_accum(str(n)+"  "+str(s))
+        logger.log_accum("{}  {}", n, s)
     return None
 
 
   def get_ancestors(self, info: SearchInfo) -> Tree:
+    # The trees are shared between searches and must not be modified.
+    # When a budget runs out the tree is returned as it is: the ancestors
+    # not searched yet keep the names found in the records (see truncated)
+    root = None
+    for found in self.iter_ancestors(info):
+      if found.child is None:
+        root = found.tree
+    return root
+
+  def iter_ancestors(self, info: SearchInfo):
+    """
+    Same search as get_ancestors, yielding a FoundNode as soon as each
+    person is resolved (the first one is the person searched)
+
+    The tree of the first node grows as the search goes on, so it can be
+    rendered again after every node. The time the caller holds each node
+    (e.g. rendering it) doesn't count against time_budget.
+    """
+    key = self._node_key(info, 0)
+    self.truncated = False
+    if (tree := self._memo_get(key)) is not None:
+      yield FoundNode(tree, None, None, 0, ())
+      return
+    if self.workers > 1 and self.graph is None:
+      pool = self._search_pool()
+      yield from self._expand(info, lambda infos: pool.map(_resolve_node_in_worker, infos),
+                              batch_size=2 * self.workers)
+    else:
+      yield from self._expand(info, lambda infos: [self._resolve_here(i) for i in infos])
+
+  def _resolve_here(self, info: SearchInfo) -> tuple[Tree, dict[str, SearchInfo]]:
+    if self.graph is None or (link := self.graph.get(info)) is None:
+      return self.resolve_node(info)
+    # A copy with its own id, _expand sets its parents
+    return replace(link.tree, id=str(uuid.uuid4())[:8]), link.jobs
+
+  def _expand(self, info: SearchInfo, resolve, batch_size: int = 1):
+    # Work queue of searches (priority, seq, node, side, info, depth, path):
+    # their tree replaces node.<side> (the root has no node). path has the
+    # searches from the root to node, a search that repeats one of them (a
+    # person found as their own ancestor) is not expanded. resolve runs
+    # resolve_node over a batch of infos, here or in the pool
+    deadline = None if self.time_budget is None else time.monotonic() + self.time_budget
+    seq = itertools.count()
+    queue = [(0, next(seq), None, None, info, 0, frozenset())]
+    # A tree goes to the memo once its whole subtree is searched, only
+    # complete trees are reused.
+    # id(tree) -> [searches left, key, nodes it hangs from, years read by
+    # its subtree so far]
+    unfinished: dict[int, list] = {}
+    n_resolved = 0
+
+    def hand_over(found: FoundNode):
+      # The deadline is paused while the caller holds the node
+      nonlocal deadline
+      paused = time.monotonic()
+      yield found
+      if deadline is not None:
+        deadline += time.monotonic() - paused
+
+    def searched(nodes, years):
+      # One search less for each node (years read by the subtree just
+      # searched), the ones with none left are complete
+      stack = [(node, years) for node in nodes]
+      while stack:
+        node, years = stack.pop()
+        if node is None:
+          continue
+        entry = unfinished[id(node)]
+        entry[0] -= 1
+        entry[3] = merge_years(entry[3], years)
+        if entry[0] == 0:
+          del unfinished[id(node)]
+          self._memo_put(entry[1], node, entry[3])
+          stack.extend((parent, entry[3]) for parent in entry[2])
+
+    while queue:
+      # The person searched is always resolved, whatever the budget
+      if n_resolved and ((deadline is not None and time.monotonic() >= deadline) or
+                         (self.max_nodes is not None and n_resolved >= self.max_nodes)):
+        self.truncated = True
+        break
+      limit = batch_size if self.max_nodes is None else max(1, min(batch_size, self.max_nodes - n_resolved))
+      # Repeated searches within a batch (pedigree collapse) run once
+      batch: dict[tuple, list] = {}
+      while queue and len(batch) < limit:
+        _, _, node, side, job, depth, path = heapq.heappop(queue)
+        key = self._node_key(job, depth)
+        if (tree := self._memo_get(key)) is not None:
+          setattr(node, side, tree)
+          searched([node], self.memo_years[key])
+          yield from hand_over(FoundNode(tree, node, side, depth, ()))
+          continue
+        batch.setdefault(key, []).append((node, side, job, depth, path))
+      results = resolve([targets[0][2] for targets in batch.values()])
+      for (key, targets), (tree, jobs) in zip(batch.items(), results):
+        self.memo_misses += 1
+        n_resolved += 1
+        for node, side, *_ in targets:
+          if node is not None:
+            setattr(node, side, tree)
+        _, _, _, depth, path = targets[0]
+        path = path | {key[0]}
+        pending = []
+        for child_side, child_info in jobs.items():
+          if self._should_expand(child_info, depth + 1, path):
+            pending.append(child_side)
+            heapq.heappush(queue, (self._priority(tree, child_info, depth + 1), next(seq),
+                                   tree, child_side, child_info, depth + 1, path))
+        parents = [node for node, *_ in targets]
+        years = search_years(targets[0][2], tree)
+        if pending:
+          unfinished[id(tree)] = [len(pending), key, parents, years]
+        else:
+          self._memo_put(key, tree, years)
+          searched(parents, years)
+        for node, side, *_ in targets:
+          yield from hand_over(FoundNode(tree, node, side, depth, tuple(pending)))
+
+  @staticmethod
+  def _priority(tree: Tree, info: SearchInfo, depth: int) -> int:
+    # Lowest first: generation by generation, but a parent whose child has
+    # a baptism of their own and whose grandparents are both named goes up
+    # to two generations ahead of the doubtful ones
+    promise = bool(tree.baut and tree.baut.year and not tree.inferred_from_siblings) + \
+        bool(info.nombre_padre and info.nombre_madre)
+    return depth - promise
+
+  def _should_expand(self, info: SearchInfo, depth: int, path: frozenset) -> bool:
+    if self.max_depth is not None and depth > self.max_depth:
+      return False
+    return self.memo_key(info) not in path
+
+  def resolve_node(self, info: SearchInfo) -> tuple[Tree, dict[str, SearchInfo]]:
+    """
+    Searches the records of one person, without going up the tree
+
+    Returns the node, whose padre and madre are placeholders built from the
+    names in the records, and the searches that replace them ("padre" and/or
+    "madre" -> SearchInfo). The log context goes in the node.
+    """
     if not info.nombre:
       print(f"{info} - Info falta nombre")
     elif not info.apellido_1:
@@ -976,14 +2277,20 @@ class Gen:
       print(f"{info} - Info falta nombre madre")
 
     id = str(uuid.uuid4())[:8]
-    logger = Logger(id, str(info))
+    if self.trace:
+      context = SearchContext()
+      logger = Logger(id, str(info), context)
+    else:
+      context = None
+      logger = _NULL_LOGGER
+    jobs: dict[str, SearchInfo] = {}
 
     bauts,is_broad = get_person_from_findings_v2(self.find_person(info), logger, "bautizo")
     baut = None
     if bauts and len(bauts)>1:
       logger.log_accum("Varios bautizos encontrados:")
       for r in bauts:
-        logger.log_accum(f" → {r}")
+        logger.log_accum(" → {}", r)
       baut = self.infer_from_siblings(bauts, logger)
       if baut:
         #TODO: rename this variable
@@ -991,7 +2298,7 @@ class Gen:
     elif bauts and len(bauts) == 1:
       baut = bauts[0]
       partial= " (coincidencia parcial)" if is_broad else ""
-      logger.log_accum(f"Bautizo encontrado{partial}:")
+      logger.log_accum("Bautizo encontrado{}:", partial)
       logger.log_accum(baut)
     logger.log_flush()
 
@@ -1013,9 +2320,9 @@ class Gen:
     inferred_from_siblings = False
 
     if siblings:
-      logger.log_accum(f"Hermanos potenciales:")
+      logger.log_accum("Hermanos potenciales:")
       for s in siblings:
-        logger.log_accum(f" → {s}")
+        logger.log_accum(" → {}", s)
 
     if not baut_ref and siblings and _INFER_PARENTS_FROM_SIBLINGS:
       if baut_ref:= self.infer_from_siblings(siblings, logger):
@@ -1045,10 +2352,10 @@ class Gen:
     has_paternos = baut_ref and baut_ref.paterno and baut_ref.paterna
     # TODO: Clarify the whole float.nan, "nan", "Missing" situation to make it clear
     if has_paternos:
-      padre = self.get_tree_parent_from_baut_v2(baut_ref.paterno, baut_ref.paterna, zpadre, year_birth)
+      jobs["padre"] = self.parent_info(baut_ref.paterno, baut_ref.paterna, zpadre, year_birth)
 
     if has_maternos:
-      madre = self.get_tree_parent_from_baut_v2(baut_ref.materno, baut_ref.materna, zmadre, year_birth)
+      jobs["madre"] = self.parent_info(baut_ref.materno, baut_ref.materna, zmadre, year_birth)
 
     #if not baut_ref or not baut_ref.padre or not baut_ref.madre or not has_maternos or not has_paternos:
     # Try to find abuelos from marrage of parents
@@ -1060,37 +2367,37 @@ class Gen:
       # TODO: Make it work so that if if only one is missing (paternos or maternos)
       # it stills helps to infer
       if has_paternos and has_maternos:
-        logger.log_accum(f"Encontrado matrimonio de los padres:")
+        logger.log_accum("Encontrado matrimonio de los padres:")
         logger.log_accum(matr)
-      elif not matr["Padres_Ella"] and not matr["Padres_El"]:
-        logger.log_accum(f"Encontrado matrimonio de los padres pero NO aparecen los abuelos.")
+      elif not matr.padres_ella and not matr.padres_el:
+        logger.log_accum("Encontrado matrimonio de los padres pero NO aparecen los abuelos.")
         logger.log_accum(matr)
       else:
-        deducido_paternos = "Deducido abuelos paternos" if matr["Padres_El"] and not has_paternos else ""
-        deducido_maternos = "Deducido abuelos maternos" if matr["Padres_Ella"] and not has_maternos else ""
-        logger.log_accum(f"Encontrado matrimonio de los padres. {deducido_maternos}{deducido_paternos}:")
+        deducido_paternos = "Deducido abuelos paternos" if matr.padres_el and not has_paternos else ""
+        deducido_maternos = "Deducido abuelos maternos" if matr.padres_ella and not has_maternos else ""
+        logger.log_accum("Encontrado matrimonio de los padres. {}{}:", deducido_maternos, deducido_paternos)
         logger.log_accum(matr)
-        if (paternos := get_abuelos(matr["Padres_El"])) and not has_paternos:
-          paterno,paterna = paternos
+        if matr.paterno and not has_paternos:
+          paterno,paterna = matr.paterno, matr.paterna
           if not zpadre.apellido_2:
-            zpadre.apellido_1 = zpadre.apellido_1 or matr["Apellido_1_El"]
-            zpadre.apellido_2 = zpadre.apellido_2 or matr["Apellido_2_El"]
-          padre = self.get_tree_parent_from_baut_v2(paterno,paterna, zpadre, year_birth)
-        if (maternos := get_abuelos(matr["Padres_Ella"])) and not has_maternos:
-          materno,materna = maternos
-          zmadre.apellido_1 = zmadre.apellido_1 or matr["Apellido_1_Ella"]
-          zmadre.apellido_2 = zmadre.apellido_2 or matr["Apellido_2_Ella"]
-          madre = self.get_tree_parent_from_baut_v2(materno,materna, zmadre, year_birth)
+            zpadre.apellido_1 = zpadre.apellido_1 or matr.apellido_1_el
+            zpadre.apellido_2 = zpadre.apellido_2 or matr.apellido_2_el
+          jobs["padre"] = self.parent_info(paterno,paterna, zpadre, year_birth)
+        if matr.materno and not has_maternos:
+          materno,materna = matr.materno, matr.materna
+          zmadre.apellido_1 = zmadre.apellido_1 or matr.apellido_1_ella
+          zmadre.apellido_2 = zmadre.apellido_2 or matr.apellido_2_ella
+          jobs["madre"] = self.parent_info(materno,materna, zmadre, year_birth)
     elif len(matrs) > 1:
-      logger.log_accum(f"Varios potenciales matrimonios de los padres encontrados. No se ha elegido ninguno:")
+      logger.log_accum("Varios potenciales matrimonios de los padres encontrados. No se ha elegido ninguno:")
       for m in matrs:
-        logger.log_accum(f" → {m}")
+        logger.log_accum(" → {}", m)
     elif not has_maternos or not has_maternos:
-      logger.log_accum(f"Matrimonio de los padres no encontrado. No se pueden deducir los abuelos.")
+      logger.log_accum("Matrimonio de los padres no encontrado. No se pueden deducir los abuelos.")
       if matrs_fin.broad_matches:
         logger.log_accum("Las siguientes opciones han sido descartadas:")
         for x in matrs_fin.broad_matches:
-          logger.log_accum(f" → {x}")
+          logger.log_accum(" → {}", x)
 
     logger.log_flush()
 
@@ -1098,7 +2405,177 @@ class Gen:
     if not baut:
       baut = get_dummy_tree(info).baut
 
-    return Tree(id=id,baut=baut, defu=defuncion, padre= padre, madre= madre, n_siblings=n_siblings, inferred_from_siblings=inferred_from_siblings)
+    tree = Tree(id=id,baut=baut, defu=defuncion, padre= padre, madre= madre, n_siblings=n_siblings, inferred_from_siblings=inferred_from_siblings, context=context)
+    return tree, jobs
+
+
+def _sorted_changes(changed: dict[str, set[int]]) -> list[list[int]]:
+  # Sheets.update result as the lists of reads_changed_years
+  return [sorted(changed.get(sheet_name, ())) for sheet_name, _ in _SHEET_ATTRIBUTES]
+
+
+# Gen of each search worker process, see Gen.get_ancestors
+_worker_gen: Gen | None = None
+
+
+def _init_search_worker(sheets: Sheets, trace: bool = True):
+  global _worker_gen
+  _worker_gen = Gen(sheets, trace=trace)
+
+
+def _resolve_node_in_worker(info: SearchInfo):
+  # The log context is sent back in the node
+  return _worker_gen.resolve_node(info)
+
+
+class Evidence(Flag):
+  # What the resolution of a search is based on
+  BAUTIZO = auto()    # Its own baptism
+  HERMANOS = auto()   # The baptism of a sibling
+  DEFUNCION = auto()  # Its death
+  PADRE = auto()      # The padre can be searched (paternal grandparents named)
+  MADRE = auto()      # Same for the madre
+
+
+@dataclass(slots=True)
+class Link:
+  # resolve_node of a search: the node (placeholder parents, log context)
+  # and the searches of its parents (the edges of the graph)
+  tree: Tree
+  jobs: dict[str, SearchInfo]
+
+  @property
+  def evidence(self) -> Evidence:
+    evidence = Evidence(0)
+    if self.tree.inferred_from_siblings:
+      evidence |= Evidence.HERMANOS
+    elif self.tree.baut and self.tree.baut.year:
+      evidence |= Evidence.BAUTIZO
+    if self.tree.defu:
+      evidence |= Evidence.DEFUNCION
+    if "padre" in self.jobs:
+      evidence |= Evidence.PADRE
+    if "madre" in self.jobs:
+      evidence |= Evidence.MADRE
+    return evidence
+
+
+class LinkageGraph:
+  """
+  Resolution of every search reachable from the baptisms of a Sheets
+
+  Built offline: every baptism is searched as a person would be searched in
+  the app (names and parents, no year) and then the searches of their
+  parents, generation by generation, until no new search appears. A Gen with
+  the graph builds the trees by following the edges, without searching the
+  records again (only the searches missing in the graph are run). Without
+  trace, the trees of the links keep no context (see Gen(trace=)).
+  """
+  def __init__(self, trace: bool = True):
+    # Gen.memo_key(info) -> Link
+    self.links: dict[tuple, Link] = {}
+    self.trace = trace
+
+  def __len__(self) -> int:
+    return len(self.links)
+
+  def get(self, info: SearchInfo) -> Link | None:
+    return self.links.get(Gen.memo_key(info))
+
+  def parents(self, info: SearchInfo) -> dict[str, tuple]:
+    # Keys of the searches of the padre and the madre
+    return {side: Gen.memo_key(job) for side, job in self.links[Gen.memo_key(info)].jobs.items()}
+
+  @classmethod
+  def build(cls, sheets: Sheets, workers: int | None = None, trace: bool = True) -> "LinkageGraph":
+    graph = cls(trace)
+    graph.link(sheets, workers)
+    return graph
+
+  def invalidate(self, changed: dict[str, set[int]] | list[list[int]]):
+    # Drops the links that read records of the years that changed, see
+    # Gen.invalidate
+    if isinstance(changed, dict):
+      changed = _sorted_changes(changed)
+    for key in list(self.links):
+      if reads_changed_years(search_years(SearchInfo(*key), self.links[key].tree), changed):
+        del self.links[key]
+
+  def link(self, sheets: Sheets, workers: int | None = None):
+    # Resolves the searches missing in the graph: the baptisms not linked
+    # yet and the parents of the links whose search was dropped
+    if workers is None:
+      workers = os.cpu_count() or 1
+    pending = {}
+    for records in sheets.baut_by_year.values():
+      for b in records:
+        info = SearchInfo(b.nombre, b.apellido_1, b.apellido_2,
+                          b.padre.nombre if b.padre else None, b.madre.nombre if b.madre else None)
+        key = Gen.memo_key(info)
+        if key not in self.links:
+          pending.setdefault(key, info)
+    for link in self.links.values():
+      for job in link.jobs.values():
+        key = Gen.memo_key(job)
+        if key not in self.links:
+          pending.setdefault(key, job)
+    with contextlib.ExitStack() as stack:
+      if workers > 1:
+        pool = stack.enter_context(ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_search_worker, initargs=(sheets, self.trace)))
+        resolve = lambda infos: pool.map(_resolve_node_in_worker, infos, chunksize=64)
+      else:
+        _init_search_worker(sheets, self.trace)
+        resolve = lambda infos: map(_resolve_node_in_worker, infos)
+      while pending:
+        log(f"Enlazando {len(pending)} búsquedas ({len(self.links)} ya enlazadas)")
+        results = resolve(list(pending.values()))
+        found = {}
+        for key, (tree, jobs) in zip(pending, results):
+          self.links[key] = Link(tree, jobs)
+          for job in jobs.values():
+            job_key = Gen.memo_key(job)
+            if job_key not in self.links and job_key not in pending:
+              found.setdefault(job_key, job)
+        pending = found
+
+
+def load_graph(corpus: Corpus, pueblos: str | list[str] | None = None,
+               cache: CorpusCache | None = None, workers: int | None = None,
+               trace: bool = True) -> LinkageGraph:
+  # The graph of a selection of towns, from the cache if it was built before
+  key = corpus.key(pueblos)
+  if key and cache:
+    key = f"{key}-{rules_fingerprint()}-{'trace' if trace else 'notrace'}"
+    # An empty graph is a valid one
+    if (graph := cache.get(key, "graph")) is not None:
+      return graph
+  graph = LinkageGraph.build(corpus.select(pueblos), workers, trace)
+  if key and cache:
+    cache.put(key, graph, "graph")
+  return graph
+
+def tree_to_dict(t: Tree | None, context: bool = False) -> dict | None:
+  # JSON serializable version of the tree. Placeholder people (built from
+  # the names in the records, year 0) have no bautizo. With context, the
+  # trace of each search as text
+  if t is None:
+    return None
+  d = {
+      "id": str(t.id),
+      "nombre": str(full_name_from_record(t.baut or t.defu)),
+      "bautizo": str(t.baut) if t.baut and t.baut.year else None,
+      "year_bautizo": t.baut.year if t.baut and t.baut.year else None,
+      "defuncion": str(t.defu) if t.defu else None,
+      "year_defuncion": t.defu.year if t.defu else None,
+      "n_siblings": t.n_siblings,
+      "inferred_from_siblings": t.inferred_from_siblings,
+      "padre": tree_to_dict(t.padre, context),
+      "madre": tree_to_dict(t.madre, context),
+  }
+  if context:
+    d["contexto"] = t.context.text() if t.context else None
+  return d
 
 def get_tree_size(t: Tree|None):
   if not t:
@@ -1107,22 +2584,35 @@ def get_tree_size(t: Tree|None):
   madre = get_tree_size(t.madre)
   return 1 + padre + madre
 
-def print_tree(d: Tree, level: int = 0, is_last: bool = False, padding=""):
-  if d is None:
-    return
+def _tree_rows(tree: Tree | None):
+  # (node, prefix) of each line of the tree, each person before its parents.
+  # The prefix is the padding and the arrow ("│   ├── "). Without recursion,
+  # so the cost is linear in the lines written
+  stack = [(tree, 0, False, "")]
+  while stack:
+    d, level, is_last, padding = stack.pop()
+    if d is None:
+      continue
+    arrow = ""
+    if level:
+      arrow = "└── " if is_last else "├── "
+    yield d, padding + arrow
+    if level:
+      padding += "    " if is_last else "│   "
+    stack.append((d.madre, level+1, True, padding))
+    stack.append((d.padre, level+1, False, padding))
+
+
+def _person_label(d: Tree) -> tuple[str, str]:
+  # Name and the rest of the line of a person: years and siblings
   year_baut = ""
   year_defu = ""
   full_name = ""
-  record = ""
   if d.baut:
     full_name = full_name_from_record(d.baut)
-    record = d.baut
     year_baut = d.baut.year
   if d.defu:
     year_defu = d.defu.year
-    # If year_baut is 0 it means it is a dummy bautizo
-    if not record or not year_baut:
-      record = d.defu
     if not d.baut:
       full_name = full_name_from_record(d.defu)
 
@@ -1132,82 +2622,65 @@ def print_tree(d: Tree, level: int = 0, is_last: bool = False, padding=""):
     y2 = str(year_defu) if year_defu else ""
     years = f" ({y1}-{y2})"
 
-  arrow = ""
-  if level:
-    arrow = "└── " if is_last else "├── "
-
   n_siblings = ""
   if d.n_siblings and not d.inferred_from_siblings:
     n_siblings = f" [*{d.n_siblings}] "
   elif d.n_siblings and d.inferred_from_siblings:
     n_siblings = f" [!{d.n_siblings}] "
+  return str(full_name), f"{years}{n_siblings}"
 
-  print(f"{padding}{arrow}{full_name}{years}{n_siblings}")
 
-  if level:
-    if is_last:
-      padding += "    "
-    else:
-      padding += "│   "
-  print_tree(d.padre, level+1, False, padding)
-  print_tree(d.madre, level+1, True, padding)
+def print_tree(d: Tree):
+  lines = []
+  for node, prefix in _tree_rows(d):
+    full_name, rest = _person_label(node)
+    lines.append(f"{prefix}{full_name}{rest}")
+  if lines:
+    print("\n".join(lines))
 
 
-def get_tree_html(d: Tree, level: int = 0, is_last: bool = False, padding=""):
-  if d is None:
-    return ""
-  year_baut = ""
-  year_defu = ""
-  full_name = ""
-  if d.baut:
-    full_name = full_name_from_record(d.baut)
-    year_baut = d.baut.year
-  if d.defu:
-    year_defu = d.defu.year
-    if not d.baut:
-      full_name = full_name_from_record(d.defu)
-
-  years = ""
-  if year_baut or year_defu:
-    y1 = str(year_baut) if year_baut else ""
-    y2 = str(year_defu) if year_defu else ""
-    years = f" ({y1}-{y2})"
-
-  arrow = ""
-  if level:
-    arrow = "└──&nbsp;" if is_last else "├──&nbsp;"
-
-  n_siblings = ""
-  if d.n_siblings and not d.inferred_from_siblings:
-    n_siblings = f" [*{d.n_siblings}] "
-  elif d.n_siblings and d.inferred_from_siblings:
-    n_siblings = f" [!{d.n_siblings}] "
-
-  if context_map[d.id]:
-    s = f"<span id='person_{d.id}' class='person' onclick='show_context(\"{d.id}\")' style='cursor:pointer'>{padding}{arrow}<b>{full_name}</b>{years}{n_siblings}</span><br>"
-  else:
-    s = f"<span id='person_{d.id}' class='person' onclick='show_context(\"{d.id}\")'>{padding}{arrow}{full_name}{years}{n_siblings}</span><br>"
-  #output += s
+def get_tree_json(tree: Tree | None, contexts: bool = True) -> str:
+  """
+  Compact JSON of the tree for rendering it in the browser (see get_webpage)
 
-  if level:
-    if is_last:
-      padding += "&nbsp;&nbsp;&nbsp;&nbsp;"
-    else:
-      padding += "│&nbsp;&nbsp;&nbsp;"
-  p1 = get_tree_html(d.padre, level+1, False, padding)
-  p2 = get_tree_html(d.madre, level+1, True, padding)
-  return s + p1 + p2
-
-def get_webpage(tree):
-    output = get_tree_html(tree)
-    context_html = ""
-    for id, l in context_map.items():
-        context_person = f"<div id='context_{id}' style='display:none'>"
-        for s in l:
-            context_person += f"{s}<br>"
-        context_person += f"</div>"
-        context_html += f"{context_person}"
+  {"people": [[id, name, rest, padre, madre, has_context], ...],
+   "contexts": {id: html}}
 
+  Each person is written once, even if reached through several paths
+  (pedigree collapse): padre and madre are indexes in people (-1 if
+  missing) and the root is people[0]. rest is what follows the name in its
+  line (years and siblings). With contexts, the trace of each search
+  rendered as html; has_context is 1 only for the people whose trace is
+  included.
+  """
+  people = []
+  contexts_html = {}
+  index = {}
+  nodes = []
+
+  def index_of(t):
+    if t is None:
+      return -1
+    if t.id not in index:
+      index[t.id] = len(nodes)
+      nodes.append(t)
+    return index[t.id]
+
+  index_of(tree)
+  # nodes grows while it is walked (breadth first)
+  for t in nodes:
+    full_name, rest = _person_label(t)
+    has_context = contexts and bool(t.context)
+    people.append([str(t.id), full_name, rest, index_of(t.padre), index_of(t.madre), int(has_context)])
+    if has_context:
+      contexts_html[str(t.id)] = "".join(f"{s}<br>" for s in t.context.html())
+  return json.dumps({"people": people, "contexts": contexts_html},
+                    ensure_ascii=False, separators=(",", ":"))
+
+def get_webpage(tree, contexts: bool = True):
+    # The tree is drawn by the browser from its JSON. "</" is escaped so
+    # that no record can close the script
+    tree_json = get_tree_json(tree, contexts).replace("</", "<\\/")
     c = """
     <html>
     <meta charset="UTF-8">
@@ -1221,29 +2694,29 @@ def get_webpage(tree):
     }
     </style>
     <script>
-    let currentHighlightedId = null;
+    let currentHighlightedLine = null;
 
-    function show_context(id) {
+    function show_context(id, line) {
         // Update context
-        var z = document.getElementById("context_"+id).innerHTML;
+        var z = TREE.contexts[id] || "";
         document.getElementById("context").innerHTML = z;
 
         // Remove previous highlight
-        if (currentHighlightedId) {
-            const prevElement = document.getElementById("person_"+currentHighlightedId);
+        if (currentHighlightedLine !== null) {
+            const prevElement = document.getElementById("line_"+currentHighlightedLine);
             if (prevElement) {
                 prevElement.classList.remove('highlighted');
             }
         }
 
         // Add new highlight
-        const newElement = document.getElementById("person_"+id);
+        const newElement = document.getElementById("line_"+line);
         if (newElement) {
             newElement.classList.add('highlighted');
         }
 
-        // Update current highlighted ID
-        currentHighlightedId = id;
+        // Update current highlighted line
+        currentHighlightedLine = line;
     }
     </script>
     <div id="context" style="border: solid 1px; font-family:'Open Sans', sans-serif; height:25vh;position: fixed; top: 0; left: 0; right: 0; width: 100%; max-height: 25vh; overflow-y: auto; background-color: #f9f9f9; padding: 10px; border-bottom: 1px solid #ccc; box-sizing: border-box; z-index: 1000;">
@@ -1251,14 +2724,38 @@ def get_webpage(tree):
     </div>
     <div id="tree" style="font-family: Consolas, 'Courier New', monospace;padding-top: 25vh">
     """
-    c += f"""
-    {output}
-    </div>
-    <hr>
-    {context_html}
-    """
+    c += "</div>\n    <hr>\n    <script>\n    const TREE = " + tree_json + ";\n"
     c += """
-    <script>
+    // Same lines as print_tree, without recursion. A person reached through
+    // several paths is drawn once per path, so each line has its own id
+    function render_tree(tree) {
+        const out = [];
+        const stack = tree.people.length ? [[0, 0, false, ""]] : [];
+        while (stack.length) {
+            const [i, level, is_last, padding] = stack.pop();
+            if (i < 0) {
+                continue;
+            }
+            const [id, name, rest, padre, madre, has_context] = tree.people[i];
+            let arrow = "";
+            if (level) {
+                arrow = is_last ? "└──&nbsp;" : "├──&nbsp;";
+            }
+            if (has_context) {
+                out.push(`<span id='line_${out.length}' class='person' onclick='show_context("${id}", ${out.length})' style='cursor:pointer'>${padding}${arrow}<b>${name}</b>${rest}</span><br>`);
+            } else {
+                out.push(`<span id='line_${out.length}' class='person' onclick='show_context("${id}", ${out.length})'>${padding}${arrow}${name}${rest}</span><br>`);
+            }
+            let next = padding;
+            if (level) {
+                next += is_last ? "&nbsp;&nbsp;&nbsp;&nbsp;" : "│&nbsp;&nbsp;&nbsp;";
+            }
+            stack.push([madre, level+1, true, next], [padre, level+1, false, next]);
+        }
+        return out.join("");
+    }
+    document.getElementById("tree").innerHTML = render_tree(TREE);
+
     function redirectToTree() {
         const tree = document.getElementById("tree");
         // Scroll into view smoothly
@@ -1,8 +1,13 @@
+import time
 import streamlit.components.v1 as components
 import streamlit as st
 import pandas as pd
 import lib
 
+# Seconds a search can take, so that a lineage that keeps matching doesn't
+# leave the page waiting
+SEARCH_TIME_BUDGET = 20
+
 st.set_page_config(layout="wide")
 # Show title and description.
 st.title("(GenReMur) Buscador Recursivo de antepasados Murcia")
@@ -19,42 +24,55 @@ st.markdown("""
 @st.fragment
 def upload_widget():
     # Let the user upload a file via `st.file_uploader`.
-    uploaded_file = st.file_uploader("", type=("xlsx"),
-        help="Sube aquí el archivo Excel. El concimiento del programa está limitado a este archivo."
+    uploaded_files = st.file_uploader("", type=("xlsx"), accept_multiple_files=True,
+        help="Sube aquí el archivo Excel (o varios, uno por pueblo). El concimiento del programa está limitado a estos archivos."
     )
 
-    if uploaded_file:
-        with st.spinner('(1) Cargando Excel, limpiando datos, marcando celdas ausentes, estandarizando nombres...'):
-            baut_all, matr_all, defu_all = lib.load_all_sheets_in_colab(
-                uploaded_file.read())
-
-        with st.spinner('(2) Separando nombre y apellidos, agrupando datos por año...'):
-            from collections import defaultdict
-            defu_by_year: dict[int, list] = defaultdict(list)
-            for year, group in defu_all.groupby('Año'):
-                for _, row in group.iterrows():
-                    if x := lib.Defuncion.defu_from_series(row):
-                        defu_by_year[year].append(x)
-            baut_by_year: dict[int, list] = defaultdict(list)
-            for year, group in baut_all.groupby('Año'):
-                for _, row in group.iterrows():
-                    if x := lib.Bautizo.baut_from_series(row):
-                        baut_by_year[year].append(x)
-
-            matr_by_year = {year: group.to_dict(
-                'records') for year, group in matr_all.groupby('Año')}
-            sheets = lib.Sheets(
-                baut_by_year=baut_by_year, matr_by_year=matr_by_year, defu_by_year=defu_by_year)
-            st.session_state["sheets"] = sheets
+    if uploaded_files:
+        # Each Excel is a town, named after the file. Workbooks that were
+        # already processed are loaded from disk
+        files_key = tuple(f.file_id for f in uploaded_files)
+        if st.session_state.get("corpus_files") != files_key:
+            files = {lib.town_name(f.name): f.read() for f in uploaded_files}
+            corpus = st.session_state.get("corpus")
+            if corpus is not None and set(files) == set(corpus.towns):
+                # Same towns, new versions of their Excels (e.g. downloaded
+                # again with more rows): only the new rows are processed
+                with st.spinner('(1) Actualizando Excel con las filas nuevas...'):
+                    for pueblo, data in files.items():
+                        if corpus.keys.get(pueblo) != lib.workbook_key(data, pueblo):
+                            changed = corpus.update(pueblo, data, lib.CorpusCache())
+                            # Searches that read the changed years are no
+                            # longer valid
+                            gens = st.session_state.get("gens", {})
+                            for pueblos_key, g in list(gens.items()):
+                                if g.sheets is corpus.select(list(pueblos_key) or None):
+                                    g.invalidate(changed)
+                                else:
+                                    gens.pop(pueblos_key).close()
+            else:
+                with st.spinner('(1) Cargando Excel, limpiando datos, marcando celdas ausentes, estandarizando nombres, separando nombre y apellidos, agrupando datos por año...'):
+                    corpus = lib.load_corpus(files, lib.CorpusCache())
+                # Searches of the previous Excels are no longer valid
+                for g in st.session_state.get("gens", {}).values():
+                    g.close()
+                st.session_state["gens"] = {}
+            st.session_state["corpus"] = corpus
+            st.session_state["corpus_files"] = files_key
+        corpus = st.session_state["corpus"]
 
+        for pueblo, sheets in corpus.towns.items():
+            n_baut = sum(len(x) for x in sheets.baut_by_year.values())
+            n_matr = sum(len(x) for x in sheets.matr_by_year.values())
+            n_defu = sum(len(x) for x in sheets.defu_by_year.values())
             year_baut = ", ".join(
-                lib.get_year_ranges(list(baut_by_year.keys())))
+                lib.get_year_ranges(sorted(sheets.baut_by_year.keys())))
             year_matr = ", ".join(
-                lib.get_year_ranges(list(matr_by_year.keys())))
+                lib.get_year_ranges(sorted(sheets.matr_by_year.keys())))
             year_defu = ", ".join(
-                lib.get_year_ranges(list(defu_by_year.keys())))
+                lib.get_year_ranges(sorted(sheets.defu_by_year.keys())))
             st.markdown(
-                f"Excel procesado con éxito. Contiene los siguientes registros:  \n{len(baut_all)} Bautizos (Años: {year_baut})  \n{len(matr_all)} Matrimonios (Años: {year_matr})  \n{len(defu_all)} Defunciones (Años: {year_defu})")
+                f"Excel de **{pueblo}** procesado con éxito. Contiene los siguientes registros:  \n{n_baut} Bautizos (Años: {year_baut})  \n{n_matr} Matrimonios (Años: {year_matr})  \n{n_defu} Defunciones (Años: {year_defu})")
 
 
 @st.fragment
@@ -73,9 +91,13 @@ def person_form():
                      unsafe_allow_html=True)
             submitted = st.form_submit_button(
                 "Buscar", use_container_width=True)
+        pueblos_val = []
+        if "corpus" in st.session_state and len(st.session_state["corpus"].pueblos) > 1:
+            pueblos_val = st.multiselect(
+                "Pueblos en los que buscar (vacío = todos)", st.session_state["corpus"].pueblos)
 
     if submitted:
-        if "sheets" in st.session_state:
+        if "corpus" in st.session_state:
             error = ""
             n_missing = 0
             if not nombre_val:
@@ -101,22 +123,51 @@ def person_form():
                 apellido1 = (apellido_1_val if apellido_1_val else "_")
                 apellido2 = (apellido_2_val if apellido_2_val else "_")
                 with st.spinner(f'(3) Buscando antepasados de {nombre} {apellido1} {apellido2}...'):
-                    g = lib.Gen(sheets=st.session_state['sheets'])
-                    z = g.get_ancestors(lib.SearchInfo(
+                    # One Gen per selection of towns, kept in the session so
+                    # that later searches reuse the ancestors already found
+                    gens = st.session_state.setdefault("gens", {})
+                    pueblos_key = tuple(sorted(pueblos_val))
+                    if pueblos_key not in gens:
+                        gens[pueblos_key] = lib.Gen(sheets=st.session_state['corpus'],
+                                                    pueblos=pueblos_val or None,
+                                                    time_budget=SEARCH_TIME_BUDGET)
+                    g = gens[pueblos_key]
+                    # The tree is drawn as soon as the person is found and
+                    # drawn again (at most once a second) as the ancestors
+                    # are found
+                    summary = st.empty()
+                    tree_view = st.empty()
+                    z = None
+                    n_found = 0
+                    last_render = 0.0
+                    for found in g.iter_ancestors(lib.SearchInfo(
                         nombre_val,
                         apellido_1_val,
                         apellido_2_val,
                         nombre_padre_val,
                         nombre_madre_val,
-                    ))
-                    webpage = lib.get_webpage(z)
-                    size = lib.get_tree_size(z)
+                    )):
+                        if found.child is None:
+                            z = found.tree
+                        n_found += 1
+                        if time.monotonic() - last_render >= 1:
+                            summary.markdown(f"Buscando... {n_found} personas encontradas hasta ahora")
+                            # Without the contexts, only the final tree is clickable
+                            with tree_view.container():
+                                components.html(lib.get_webpage(z, contexts=False), height=700, scrolling=True)
+                            last_render = time.monotonic()
+                size = lib.get_tree_size(z)
+                with summary.container():
                     if size <= 3:
                         st.markdown(
                             "**No se ha encontrado a esta persona en el Excel**")
                     else:
                         st.markdown(f"Deducido árbol con {size} miembros")
-                components.html(webpage, height=700, scrolling=True)
+                    if g.truncated:
+                        st.markdown(
+                            f"La búsqueda se ha detenido tras {SEARCH_TIME_BUDGET} segundos, los antepasados más lejanos pueden faltar.")
+                with tree_view.container():
+                    components.html(lib.get_webpage(z), height=700, scrolling=True)
         else:
             st.markdown(
                 "**Antes de continuar debes subir un Excel en el que buscar**.")
@@ -0,0 +1,154 @@
+import contextlib
+import io
+import os
+import random
+import sys
+
+import openpyxl
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lib
+
+MALE = ["Jose", "Juan", "Antonio", "Francisco", "Pedro", "Manuel", "Gines", "Pascual", "Joaquin",
+        "Tomas", "Salvador", "Ramon", "Mateo", "Luis", "Jose Maria", "Juan Antonio"]
+FEMALE = ["Maria", "Juana", "Josefa", "Antonia", "Francisca", "Catalina", "Isabel", "Ana", "Dolores",
+          "Maria Dolores", "Encarnacion", "Trinidad", "Teresa", "Lucia", "Juana Maria"]
+SURNAMES = ["Martinez", "Sanchez", "Perez", "Lopez", "Garcia", "Fernandez", "Hernandez", "Jimenez",
+            "Molina", "Marin", "Ruiz", "Gomez", "Cano", "Yelo", "Gil", "Ramos", "Ramon", "Sola",
+            "de la Cuesta", "Marin-Ordoñez", "Penalva", "Cuadrado"]
+# Spellings the cleaning has to undo
+VARIANTS = {"Jimenez": "Ximenez", "Isabel": "Ysabel", "Jose": "Joseph", "Josefa": "Josepha",
+            "Martinez": "Martines", "Maria": "Mª", "Tomas": "Thomas", "Salvador": "Salbador"}
+
+COLUMNS = {
+    "Bautismos": ["N°", "Año", "Nombre", "Apellido 1", "Apellido 2", "Nombre Padre", "Nombre Madre",
+                  "Abuelos Paternos", "Abuelos Maternos", "Observaciones"],
+    "Matrimonios": ["N°", "Año", "Nombre_El", "Apellido 1_El", "Apellido 2_El", "Nombre_Ella",
+                    "Apellido 1_Ella", "Apellido 2_Ella", "Padres_El", "Padres_Ella", "Observaciones"],
+    "Defunciones": ["N°", "Año", "Nombre", "Apellido 1", "Apellido 2", "Nombre Padre", "Nombre Madre",
+                    "Observaciones"],
+}
+
+
+class Person:
+  def __init__(self, nombre, apellido_1, apellido_2, male, year, padre=None, madre=None):
+    self.nombre, self.apellido_1, self.apellido_2 = nombre, apellido_1, apellido_2
+    self.male, self.year, self.padre, self.madre = male, year, padre, madre
+
+
+def synthetic_rows(seed: int = 1, n_founders: int = 80, start: int = 1700, end: int = 1800) -> dict[str, list[dict]]:
+  # Rows of the three sheets of a town: families that marry and baptize
+  # their children over several generations, with missing cells and old
+  # spellings like the real Excels
+  rng = random.Random(seed)
+
+  def noisy(s):
+    if s and rng.random() < 0.15:
+      return " ".join(VARIANTS.get(w, w) for w in s.split(" "))
+    return s
+
+  def maybe(s, p):
+    return None if rng.random() < p else s
+
+  def abuelos(p):
+    if p.padre:
+      return f"{p.padre.nombre} {p.padre.apellido_1} y {p.madre.nombre} {p.madre.apellido_1}"
+    return f"Juan {p.apellido_1} y Maria {p.apellido_2}"
+
+  singles = []
+  for _ in range(n_founders):
+    male = rng.random() < 0.5
+    singles.append(Person(rng.choice(MALE if male else FEMALE), rng.choice(SURNAMES),
+                          rng.choice(SURNAMES), male, start + rng.randint(0, 20)))
+  couples = []
+  rows = {name: [] for name in COLUMNS}
+  for year in range(start + 20, end):
+    men = [p for p in singles if p.male and 18 <= year - p.year <= 40]
+    women = [p for p in singles if not p.male and 16 <= year - p.year <= 35]
+    rng.shuffle(men)
+    rng.shuffle(women)
+    for m, f in zip(men[:len(men) // 3], women[:len(women) // 3]):
+      singles.remove(m)
+      singles.remove(f)
+      couples.append((m, f))
+      rows["Matrimonios"].append({
+          "N°": len(rows["Matrimonios"]) + 1, "Año": year, "Nombre_El": noisy(m.nombre),
+          "Apellido 1_El": m.apellido_1, "Apellido 2_El": maybe(m.apellido_2, 0.3),
+          "Nombre_Ella": noisy(f.nombre), "Apellido 1_Ella": f.apellido_1,
+          "Apellido 2_Ella": maybe(f.apellido_2, 0.3), "Padres_El": maybe(abuelos(m), 0.3),
+          "Padres_Ella": maybe(abuelos(f), 0.3)})
+    couples = [(m, f) for m, f in couples if year - f.year <= 44]
+    for m, f in couples:
+      if rng.random() > 0.15:
+        continue
+      male = rng.random() < 0.5
+      child = Person(rng.choice(MALE if male else FEMALE), m.apellido_1, f.apellido_1, male, year, m, f)
+      singles.append(child)
+      rows["Bautismos"].append({
+          "N°": len(rows["Bautismos"]) + 1, "Año": year, "Nombre": noisy(child.nombre),
+          "Apellido 1": noisy(child.apellido_1), "Apellido 2": maybe(child.apellido_2, 0.1),
+          "Nombre Padre": maybe(m.nombre, 0.05), "Nombre Madre": maybe(f.nombre, 0.05),
+          "Abuelos Paternos": maybe(abuelos(m), 0.2), "Abuelos Maternos": maybe(abuelos(f), 0.2)})
+    for p in rng.sample(singles, min(10, len(singles))):
+      if year - p.year > 20 and rng.random() < 0.3:
+        rows["Defunciones"].append({
+            "N°": len(rows["Defunciones"]) + 1, "Año": year, "Nombre": p.nombre,
+            "Apellido 1": p.apellido_1, "Apellido 2": maybe(p.apellido_2, 0.3),
+            "Nombre Padre": p.padre.nombre if p.padre else None,
+            "Nombre Madre": p.madre.nombre if p.madre else None})
+    singles = [p for p in singles if year - p.year <= 45]
+  return rows
+
+
+def workbook_bytes(rows: dict[str, list[dict]]) -> bytes:
+  wb = openpyxl.Workbook()
+  del wb["Sheet"]
+  for name, columns in COLUMNS.items():
+    ws = wb.create_sheet(name)
+    ws.append(columns)
+    for row in rows[name]:
+      ws.append([row.get(c) for c in columns])
+  f = io.BytesIO()
+  wb.save(f)
+  return f.getvalue()
+
+
+def search_info(b: lib.Bautizo) -> lib.SearchInfo:
+  # The search of a baptized person, as typed in the app
+  return lib.SearchInfo(b.nombre, b.apellido_1, b.apellido_2,
+                        b.padre.nombre if b.padre else None, b.madre.nombre if b.madre else None)
+
+
+def findings_str(f: lib.Findings) -> list[list[str]]:
+  return [[str(r) for r in matches] for matches in (f.full_matches, f.partial_matches, f.broad_matches)]
+
+
+def tree_str(tree: lib.Tree | None) -> str:
+  # print_tree has no ids, so the trees of two searches can be compared
+  out = io.StringIO()
+  with contextlib.redirect_stdout(out):
+    lib.print_tree(tree)
+  return out.getvalue()
+
+
+def records_str(sheets: lib.Sheets) -> dict:
+  return {attr: {year: [str(r) for r in records] for year, records in getattr(sheets, attr).items()}
+          for _, attr in lib._SHEET_ATTRIBUTES}
+
+
+@pytest.fixture(scope="session")
+def rows():
+  return synthetic_rows()
+
+
+@pytest.fixture(scope="session")
+def workbook(rows):
+  return workbook_bytes(rows)
+
+
+@pytest.fixture(scope="session")
+def sheets(workbook):
+  # Shared by the tests that only search, don't modify it
+  return lib.stream_sheets(workbook, max_workers=1)
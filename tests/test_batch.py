@@ -0,0 +1,36 @@
+import json
+
+import batch
+
+
+def test_read_people_skips_bad_rows(tmp_path, capsys):
+  path = tmp_path / "personas.csv"
+  path.write_text("nombre,apellido_1,apellido_2,nombre_padre,nombre_madre,year_child\n"
+                  "Juan,Perez,Gil,Jose,Maria,1800.0\n"
+                  "Ana,Lopez,Ruiz,Pedro,Juana,abc\n"
+                  "Luis,Cano,Gil,Tomas,Rosa,,sobra\n"
+                  "Rosa,Marin,,Gines,Ana,\n", encoding="utf-8")
+  people = list(batch.read_people(str(path)))
+  assert [(id, info.nombre, info.year_child) for id, info in people] == \
+      [("1", "Juan", 1800), ("3", "Luis", None), ("4", "Rosa", None)]
+  assert "Fila 2 ignorada" in capsys.readouterr().err
+
+
+def test_read_people_jsonl(tmp_path):
+  path = tmp_path / "personas.jsonl"
+  path.write_text('{"id": "a", "nombre": "Juan", "year_child": 1800.0}\n'
+                  '{"id": "b", "nombre": \n'
+                  '[1, 2]\n'
+                  '{"id": "c", "nombre": "Ana"}\n', encoding="utf-8")
+  assert [id for id, _ in batch.read_people(str(path))] == ["a", "c"]
+
+
+def test_resume_drops_cut_line(tmp_path):
+  path = tmp_path / "arboles.jsonl"
+  path.write_text('{"id": "1"}\n{"id": "2"}\n{"id": "3", "tr', encoding="utf-8")
+  batch.drop_cut_line(str(path))
+  assert batch.done_ids(str(path)) == {"1", "2"}
+  assert [json.loads(line)["id"] for line in path.read_text(encoding="utf-8").splitlines()] == ["1", "2"]
+  path.write_text('{"id": "1", "tr', encoding="utf-8")
+  batch.drop_cut_line(str(path))
+  assert path.read_text(encoding="utf-8") == ""
@@ -0,0 +1,30 @@
+import os
+import time
+
+import lib
+
+
+def test_evict_counts_and_removes_tmp_files(tmp_path):
+  cache = lib.CorpusCache(str(tmp_path), max_bytes=2500)
+  stale, fresh = tmp_path / "a.sheets.1.tmp", tmp_path / "b.sheets.2.tmp"
+  stale.write_bytes(b"x" * 5000)
+  old = time.time() - lib._CACHE_TMP_MAX_AGE - 60
+  os.utime(stale, (old, old))
+  fresh.write_bytes(b"x" * 1000)
+  for key in ("k1", "k2"):
+    (tmp_path / f"{key}.sheets").write_bytes(b"x" * 1000)
+    time.sleep(0.01)
+  cache.evict()
+  # The stale .tmp goes, the one still being written counts and pushes out
+  # the oldest entry
+  assert sorted(os.listdir(tmp_path)) == ["b.sheets.2.tmp", "k2.sheets"]
+
+
+def test_get_of_an_entry_evicted_meanwhile(tmp_path, monkeypatch):
+  cache = lib.CorpusCache(str(tmp_path))
+  cache.put("k", {"a": 1})
+
+  def evicted(path, *args):
+    raise FileNotFoundError(path)
+  monkeypatch.setattr(lib.os, "utime", evicted)
+  assert cache.get("k") == {"a": 1}
@@ -0,0 +1,9 @@
+import lib
+from conftest import records_str
+
+
+def test_dataframes_equal_stream(workbook):
+  frames = lib.load_all_sheets_in_colab(workbook, max_workers=1)
+  assert records_str(lib.build_sheets(*frames)) == records_str(lib.stream_sheets(workbook, max_workers=1))
+  assert (records_str(lib.build_sheets(*frames, pueblo="Blanca"))
+          == records_str(lib.stream_sheets(workbook, pueblo="Blanca", max_workers=1)))
@@ -0,0 +1,116 @@
+import contextlib
+import io
+import json
+import random
+import re
+import shutil
+import subprocess
+from dataclasses import astuple
+
+import pytest
+
+import bench
+import lib
+from conftest import findings_str, search_info, tree_str
+
+YEAR_RANGES = [None, (1740, 1770), (1790, 1790)]
+
+
+def misspell(rng: random.Random, s: str | None) -> str | None:
+  # One letter changed, added or removed
+  if not s or rng.random() < 0.5:
+    return s
+  i = rng.randrange(len(s))
+  return rng.choice([s[:i] + "x" + s[i + 1:], s[:i] + "e" + s[i:], s[:i] + s[i + 1:]])
+
+
+def queries(sheets: lib.Sheets, n: int = 60) -> list[lib.SearchInfo]:
+  rng = random.Random(0)
+  records = [b for l in sheets.baut_by_year.values() for b in l]
+  result = []
+  for b in rng.sample(records, n):
+    info = search_info(b)
+    result.append(info)
+    result.append(lib.SearchInfo(*(misspell(rng, x) for x in astuple(info))))
+    # Siblings
+    result.append(lib.replace(info, nombre=None))
+  result.append(lib.SearchInfo("Blas", "Martinez", None, "Jose", "Maria"))
+  return result
+
+
+def test_match_cell_equals_regex(sheets):
+  rng = random.Random(0)
+  names = sheets.vocab.names[1:] + ["", None, "Mari", "Dolores", "Maria Dolores Sanchez", "Jos"]
+  pairs = [(a, b) for a in names for b in rng.sample(names, 40)]
+  pairs += [(a, misspell(rng, a)) for a in names]
+  for cell, candidate in pairs:
+    assert lib.match_cell(cell, candidate) == bench.regex_match_cell(cell, candidate), (cell, candidate)
+
+
+def test_candidates_equal_brute_force(sheets):
+  vocab = sheets.vocab
+  rng = random.Random(1)
+  names = vocab.names[1:] + [misspell(rng, x) for x in vocab.names[1:]] + ["Blas", "Mari", "Dolores"]
+  for candidate in filter(None, names):
+    expected = [code for code in range(1, len(vocab.names))
+                if lib.match_cell(vocab.names[code], candidate) is not lib.Match.NO]
+    assert vocab.candidates(candidate) == expected, candidate
+
+
+def test_table_equals_dict_scan(sheets):
+  # The postings of the table against find_person_abstract_v2 over every record
+  for info in queries(sheets):
+    for year_range in YEAR_RANGES:
+      assert (findings_str(sheets.baut_table.find_person(info, year_range))
+              == findings_str(lib.find_person_abstract_v2(sheets.baut_by_year, info, year_range)))
+      assert (findings_str(sheets.defu_table.find_person(info, year_range))
+              == findings_str(lib.find_person_abstract_v2(sheets.defu_by_year, info, year_range)))
+
+
+@pytest.mark.parametrize("table_name", ["baut_table", "defu_table", "matr_table"])
+def test_numpy_equals_loop(sheets, monkeypatch, table_name):
+  table = getattr(sheets, table_name)
+  # Without postings every search scans a range of records
+  monkeypatch.setattr(table, "postings", {})
+  monkeypatch.setattr(lib, "_VECTORIZED_SCAN_MIN_ROWS", 0)
+  if table_name == "matr_table":
+    searches = [(lib.FullName(m.nombre_el, m.apellido_1_el, m.apellido_2_el),
+                 lib.FullName(m.nombre_ella, m.apellido_1_ella, m.apellido_2_ella))
+                for l in sheets.matr_by_year.values() for m in l[:2]]
+    find = table.find_matr
+  else:
+    searches = [(info,) for info in queries(sheets, 20)]
+    find = table.find_person
+  for args in searches:
+    for year_range in YEAR_RANGES:
+      results = {}
+      for vectorized in (False, True):
+        monkeypatch.setattr(lib, "_VECTORIZED_SCAN", vectorized)
+        results[vectorized] = findings_str(find(*args, year_range))
+      assert results[False] == results[True], (args, year_range)
+
+
+@pytest.mark.skipif(shutil.which("node") is None, reason="node no instalado")
+def test_js_render_equals_print_tree(sheets, tmp_path):
+  g = lib.Gen(sheets)
+  infos = [search_info(b) for year in (1740, 1770, 1790) for b in sheets.baut_by_year[year][:5]]
+  with contextlib.redirect_stdout(io.StringIO()):
+    trees = [g.get_ancestors(info) for info in infos] + [None]
+  js = re.search(r"(function render_tree.*?\n    })\n", lib.get_webpage(None), re.S).group(1)
+  payloads = [lib.get_tree_json(tree, contexts) for tree in trees for contexts in (True, False)]
+  (tmp_path / "trees.json").write_text(json.dumps(payloads))
+  (tmp_path / "render.js").write_text(
+      js + "\nconst ps = JSON.parse(require('fs').readFileSync(process.argv[2], 'utf8'));"
+      "\nconsole.log(JSON.stringify(ps.map(p => render_tree(JSON.parse(p)))));")
+  out = subprocess.run(["node", str(tmp_path / "render.js"), str(tmp_path / "trees.json")],
+                       capture_output=True, text=True, check=True).stdout
+  rendered = iter(json.loads(out))
+  for tree in trees:
+    for contexts in (True, False):
+      html = next(rendered)
+      ids = re.findall(r"id='(line_\d+)'", html)
+      assert len(ids) == len(set(ids))
+      if not contexts:
+        assert "<b>" not in html
+      text = re.sub(r"<[^>]+>", "", html.replace("<br>", "\n")).replace("&nbsp;", " ")
+      assert text == tree_str(tree)
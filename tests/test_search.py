@@ -0,0 +1,18 @@
+import contextlib
+import io
+
+import lib
+from conftest import search_info, tree_str
+
+
+def test_exhausted_budget_still_finds_person(sheets):
+  info = search_info(sheets.baut_by_year[1790][0])
+  full = lib.Gen(sheets).get_ancestors(info)
+  for kwargs in ({"time_budget": 0}, {"time_budget": -1}, {"max_nodes": 0}):
+    g = lib.Gen(sheets, **kwargs)
+    with contextlib.redirect_stdout(io.StringIO()):
+      tree = g.get_ancestors(info)
+    assert tree is not None and g.truncated
+    assert tree.baut == full.baut
+    # Only the person searched, the parents keep the names of the records
+    assert tree_str(tree) != tree_str(full)
@@ -0,0 +1,62 @@
+import contextlib
+import copy
+import io
+
+import lib
+from conftest import findings_str, records_str, search_info, synthetic_rows, tree_str, workbook_bytes
+
+
+def quiet(f, *args):
+  with contextlib.redirect_stdout(io.StringIO()):
+    return f(*args)
+
+
+def test_update_then_search_finds_new_names():
+  rows = synthetic_rows(seed=2)
+  sheets = lib.stream_sheets(workbook_bytes(rows), max_workers=1)
+  g = lib.Gen(sheets)
+  # Blas is not in the Excel, so its (empty) postings are the most
+  # selective and the candidates of Blas decide what is checked
+  info = lib.SearchInfo("Blas", "Martinez", "Perez", "Jose", "Maria")
+  before = g.find_person(info)
+
+  # A name one letter away from Blas, new in the vocabulary
+  rows = copy.deepcopy(rows)
+  rows["Bautismos"].append({"N°": 99999, "Año": 1790, "Nombre": "Bles", "Apellido 1": "Martinez",
+                            "Apellido 2": "Perez", "Nombre Padre": "Jose", "Nombre Madre": "Maria"})
+  data = workbook_bytes(rows)
+  changed = sheets.update(data)
+  assert changed["Bautismos"] == {1790}
+  g.invalidate(changed)
+  # Another search refreshes the name index first
+  g.find_person(lib.SearchInfo("Juan", "Perez", "Gil", "Pedro", "Ana"))
+
+  after = g.find_person(info)
+  fresh = lib.Gen(lib.stream_sheets(data, max_workers=1)).find_person(info)
+  assert findings_str(after) == findings_str(fresh)
+  assert any("Bles" in r for matches in findings_str(after) for r in matches)
+  assert findings_str(after) != findings_str(before)
+
+
+def test_update_equals_reload():
+  rows = synthetic_rows(seed=3)
+  sheets = lib.stream_sheets(workbook_bytes(rows), max_workers=1)
+  g = lib.Gen(sheets)
+  queries = [search_info(b) for b in sheets.baut_by_year[1760][:5] + sheets.baut_by_year[1790][:5]]
+  for info in queries:
+    quiet(g.get_ancestors, info)
+
+  # Rows added, removed and edited
+  rows = copy.deepcopy(rows)
+  new = [dict(r, **{"N°": 90000 + i, "Año": 1785}) for i, r in enumerate(rows["Bautismos"][:20])]
+  rows["Bautismos"] = rows["Bautismos"][40:] + new
+  rows["Bautismos"][10]["Nombre"] = "Ginesa"
+  del rows["Matrimonios"][5]
+  data = workbook_bytes(rows)
+  g.invalidate(sheets.update(data))
+
+  fresh = lib.stream_sheets(data, max_workers=1)
+  assert records_str(sheets) == records_str(fresh)
+  g_fresh = lib.Gen(fresh)
+  for info in queries:
+    assert tree_str(quiet(g.get_ancestors, info)) == tree_str(quiet(g_fresh.get_ancestors, info))